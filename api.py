@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from datetime import datetime as dt
+from datetime import timedelta as td
+import tools as tl
+from flash_analysis import Analysis
+from nwc_extrapolation import ExtrapolatedNWC
+
+
+@dataclass
+class Nowcast:
+    """Probability of thunder nowcast in memory
+
+    data has shape (n_leadtimes, ny, nx) with values 0-100 (%), valid_times are the
+    valid times of its lead times. source is "extrapolation" when flash observations
+    were analysed and extrapolated, or "model" when the MNWC forecast is used as is.
+    Can be given to WriteData as is.
+    """
+    data: np.array
+    analysis_time: dt
+    valid_times: list
+    latitudes: np.array = None
+    longitudes: np.array = None
+    motion_field: np.array = None
+    source: str = "extrapolation"
+
+
+def analysis(background: np.array, latitudes: np.array, longitudes: np.array, flashes: pd.DataFrame) -> np.array:
+    """0h POT analysis of flashes on top of 2D MNWC tstm background
+
+    flashes has the columns of FlashObservationClient.read, i.e. latitude, longitude,
+    elevation and flash (weight in %). background is not modified.
+    """
+    return Analysis(obs=flashes, background=background, latitudes=latitudes, longitudes=longitudes).output
+
+
+def extrapolate(rprate: np.array, pot: np.array, analysis_time: dt,
+                rprate_mask: np.array = None,
+                rprate_times: list = None,
+                n_leadtimes: int = 17,
+                time_step: td = td(minutes=15),
+                latitudes: np.array = None,
+                longitudes: np.array = None,
+                tiles: tuple = None,
+                tile_workers: int = 1,
+                motion_factor: int = 1,
+                motion_state=None) -> Nowcast:
+    """Extrapolate 2D POT analysis with the motion of rprate frames (oldest first)
+
+    rprate is used without copying, so missing data (9999 or masked in rprate_mask)
+    is set to nan in it. rprate_times, the valid times of the frames, are needed only
+    with motion_state.
+    """
+    fcst = ExtrapolatedNWC(rprate, rprate_mask, n_leadtimes, pot_data=pot, tiles=tiles, tile_workers=tile_workers,
+                           motion_factor=motion_factor, motion_state=motion_state, valid_times=rprate_times)
+    fcst = tl.convert_nan_to_zeros(fcst)
+    return Nowcast(fcst.data, analysis_time, [analysis_time + i * time_step for i in range(n_leadtimes)],
+                   latitudes, longitudes, fcst.V, "extrapolation")
+
+
+def nowcast(rprate: np.array, tstm: np.array, latitudes: np.array, longitudes: np.array,
+            flashes: pd.DataFrame, analysis_time: dt,
+            n_leadtimes: int = 17,
+            time_step: td = td(minutes=15),
+            **kwargs) -> Nowcast:
+    """Probability of thunder nowcast from arrays, like generate_propability_of_thunder.py from files
+
+    rprate has the precipitation frames (n_frames, ny, nx) oldest first, tstm the MNWC
+    probability of thunder with its 0h field first. Without flashes the first n_leadtimes
+    fields of tstm are returned as the nowcast. Other keyword arguments are passed
+    to extrapolate.
+    """
+    tstm = np.asarray(tstm)
+    if tstm.ndim == 2:
+        tstm = tstm[np.newaxis]
+    if flashes is None or len(flashes) == 0:
+        if len(tstm) < n_leadtimes:
+            raise ValueError(f"No flashes and only {len(tstm)} tstm fields for {n_leadtimes} lead times")
+        return Nowcast(tstm[:n_leadtimes], analysis_time,
+                       [analysis_time + i * time_step for i in range(n_leadtimes)],
+                       latitudes, longitudes, None, "model")
+    pot = analysis(tstm[0], latitudes, longitudes, flashes)
+    return extrapolate(rprate, pot, analysis_time, n_leadtimes=n_leadtimes, time_step=time_step,
+                       latitudes=latitudes, longitudes=longitudes, **kwargs)
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+from datetime import datetime as dt
+from datetime import timedelta as td
+from concurrent.futures import ProcessPoolExecutor
+import generate_propability_of_thunder as pot
+from s3_upload import wait_for_uploads
+
+
+def main():
+    """Reprocess thundercast over a range of analysis times
+
+    Cycles are planned together and split into contiguous chunks, one chunk per worker
+    process. Consecutive cycles of a chunk share decoded rprate frames, grid
+    coordinates, analysis context and flash buckets of their worker process.
+    """
+    args = parse_command_line()
+    start_times = plan_cycles(args.start_time, args.end_time)
+    n_chunks = max(min(args.workers, len(start_times)), 1)
+    chunk_size = -(-len(start_times) // n_chunks)
+    chunks = [start_times[i:i + chunk_size] for i in range(0, len(start_times), chunk_size)]
+    print(f"Backfilling {len(start_times)} cycles with {len(chunks)} workers")
+    start = time.time()
+    failed = []
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        for chunk_failed in executor.map(run_cycles, [args] * len(chunks), chunks):
+            failed.extend(chunk_failed)
+    print("Backfilled {} cycles in {:.2f} seconds".format(len(start_times), time.time() - start))
+    if len(failed) > 0:
+        print(f"Failed cycles and uploads: {' '.join(failed)}")
+        sys.exit(1)
+
+
+def plan_cycles(start_time: str, end_time: str, time_freq: int = 15) -> list:
+    """Analysis times from start_time to end_time, both inclusive"""
+    start = dt.strptime(start_time, "%Y%m%d%H%M")
+    end = dt.strptime(end_time, "%Y%m%d%H%M")
+    start_times = []
+    while start <= end:
+        start_times.append(start.strftime("%Y%m%d%H%M"))
+        start += td(minutes=time_freq)
+    return start_times
+
+
+def run_cycles(args, start_times: list) -> list:
+    """Run consecutive cycles in one process, return start times of the failed ones"""
+    failed = []
+    if args.frame_cache_dir is not None:
+        # Frame stores and motion states follow time, so parallel workers must not share them
+        args.frame_cache_dir = os.path.join(args.frame_cache_dir, start_times[0])
+    if args.motion_state_file is not None:
+        args.motion_state_file = f"{args.motion_state_file}.{start_times[0]}"
+    for start_time in start_times:
+        if not pot.run_cycle_safely(pot.cycle_arguments(args, start_time)):
+            failed.append(start_time)
+    # Worker process must not exit before its outputs are uploaded
+    failed.extend(wait_for_uploads())
+    return failed
+
+
+def parse_command_line():
+    parser = pot.build_parser()
+    parser.add_argument("--end_time", action="store", type=str, required=True)
+    parser.add_argument("--workers", action="store", type=int, default=4,
+                        help="Number of worker processes")
+    args = parser.parse_args()
+    if args.start_time is None:
+        parser.error("the following arguments are required: --start_time")
+    if "{start_time}" not in args.output:
+        parser.error("--output must contain '{start_time}'")
+    pot.check_arguments(parser, args)
+    return args
+
+
+if __name__ == '__main__':
+    main()
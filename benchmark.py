@@ -0,0 +1,197 @@
+import os
+import time
+import json
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from datetime import datetime as dt
+from datetime import timedelta as td
+from eccodes import (codes_grib_new_from_samples, codes_set_long, codes_set, codes_set_values,
+                     codes_write, codes_release, codes_clone)
+import tools as tl
+import generate_propability_of_thunder as pot
+from file_utils import ReadData, WriteData, DATASET_CACHE, GRID_CACHE
+from flash_analysis import Analysis, ANALYSIS_CONTEXTS
+from flash_archive import FlashArchive
+from flash_obs import FlashObservationClient, FLASH_CLIENT, epoch
+from nwc_extrapolation import ExtrapolatedNWC
+from grib_index import GRIB_INDEXES
+
+# Synthetic grid covers roughly the Scandinavian domain
+LAT_RANGE = (55.0, 70.0)
+LON_RANGE = (5.0, 35.0)
+
+
+def main():
+    """Offline benchmark of every pipeline stage on synthetic data
+
+    Generates synthetic rprate and MNWC tstm grib files and lightning flashes for each
+    grid size, times each stage and the full cycle, profiles their memory in separate
+    runs, and writes the results as JSON.
+    """
+    args = parse_command_line()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="thundercast_benchmark_")
+    results = []
+    for size in args.sizes:
+        ny, nx = (int(n) for n in size.lower().split("x"))
+        print(f"Benchmarking grid {ny}x{nx}")
+        results.append(benchmark_grid(ny, nx, os.path.join(workdir, size), args.start_time, args.repeat))
+    with open(args.output, "w") as fp:
+        json.dump({"start_time": args.start_time, "results": results}, fp, indent=2)
+    print(f"Wrote {args.output}")
+
+
+def benchmark_grid(ny: int, nx: int, workdir: str, start_time: str, repeat: int) -> dict:
+    data_root, flash_dir = generate_synthetic_data(ny, nx, workdir, start_time)
+    rprate_files, mnwc_tstm_file = tl.generate_cycle_file_paths(start_time, data_root)
+    initial_files = tl.validate_and_sort_filenames(rprate_files[::-1])
+    obs = FlashObservationClient(archive=FlashArchive(flash_dir), offline=True).read(start_time, 20)
+    output = os.path.join(workdir, "output.grib2")
+    stages = {}
+
+    rprate = measure(stages, "read_rprate", repeat, lambda: [ReadData(f) for f in initial_files])
+    measure(stages, "read_tstm", repeat, lambda: ReadData(mnwc_tstm_file, read_coordinates=True,
+                                                          use_as_template=True, leadtimes=[0]))
+    analysis = measure(stages, "analysis", repeat, lambda: Analysis(mnwc_tstm_file, start_time, 20, obs=obs))
+    analysis_info = tl.create_dict(rprate[0])
+    for data in rprate[1:]:
+        analysis_info = tl.add_to_dict(analysis_info, data)
+    nwc_data = tl.generate_nowcast_array(analysis_info)
+    measure(stages, "motion", repeat, lambda: tl.calculate_wind_field(nwc_data.data.copy(), nwc_data.mask))
+    fcst = measure(stages, "extrapolation", repeat,
+                   lambda: ExtrapolatedNWC(nwc_data.data.copy(), nwc_data.mask, pot_data=analysis.output))
+    fcst = tl.convert_nan_to_zeros(fcst)
+    # WriteData releases its template, so every run gets a clone
+    template = ReadData(mnwc_tstm_file, use_as_template=True).template
+    measure(stages, "write", repeat, lambda: WriteData(fcst, codes_clone(template), output, "local"))
+
+    args = pot.build_parser().parse_args(["--wind_field_param", "rprate", "--obs_time_window", "20",
+                                          "--file_source", "local", "--output", output,
+                                          "--data_root", data_root, "--flash_archive", flash_dir, "--offline"])
+    # Every full cycle starts cold, like a separate process would, except for imported libraries
+    def full_cycle():
+        pot.FRAME_STORE = None
+        FLASH_CLIENT.archive = None
+        FLASH_CLIENT.buckets.clear()
+        GRID_CACHE.coordinates.clear()
+        ANALYSIS_CONTEXTS.clear()
+        GRIB_INDEXES.clear()
+        pot.run_cycle(pot.cycle_arguments(args, start_time))
+    measure(stages, "full_cycle", repeat, full_cycle)
+    return {"grid": [ny, nx], "stages": stages}
+
+
+def measure(stages: dict, name: str, repeat: int, function):
+    """Run function repeat times, store best wall and cpu time, then profile memory of one more run
+
+    Timed runs are not traced. Peak resident memory includes native allocations of eccodes,
+    gridpp and pysteps, it is the peak of the run only where it can be reset (Linux), see
+    tools.reset_peak_memory. Peak traced memory is that of Python allocations only.
+    """
+    wall = []
+    cpu = []
+    result = None
+    for i in range(repeat):
+        # Every run decodes its input again
+        DATASET_CACHE.clear()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        result = function()
+        wall.append(time.perf_counter() - start_wall)
+        cpu.append(time.process_time() - start_cpu)
+    # Result of the timed runs is dropped, so it is not counted in the profiled run
+    DATASET_CACHE.clear()
+    result = None
+    tl.reset_peak_memory()
+    tracemalloc.start()
+    result = function()
+    traced_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    rss_mb = tl.peak_memory_mb()
+    stages[name] = {"wall_seconds": min(wall), "cpu_seconds": min(cpu), "peak_rss_mb": rss_mb,
+                    "peak_rss_of_run": tl.PEAK_MEMORY_RESET, "peak_traced_mb": traced_mb}
+    print("{}: {:.3f} s, peak RSS {:.1f} MB, peak traced {:.1f} MB".format(name, min(wall), rss_mb, traced_mb))
+    return result
+
+
+def generate_synthetic_data(ny: int, nx: int, workdir: str, start_time: str, n_leadtimes: int = 17):
+    """Write synthetic rprate and tstm files in run_pot_nwc.sh layout and a flash archive"""
+    analysis_time = dt.strptime(start_time, "%Y%m%d%H%M")
+    data_root = os.path.join(workdir, "data")
+    os.makedirs(os.path.join(data_root, start_time), exist_ok=True)
+    # Blobs move 2 pixels per 15 min to east and 1 to south
+    for i, nwc_time in enumerate(tl.generate_nowcast_times(start_time)):
+        path = os.path.join(data_root, start_time, f"{nwc_time}-hrnwc-rprate.grib2")
+        field = synthetic_field(ny, nx, shift=(-i, -2 * i), scale=10.0)
+        write_synthetic_grib(path, [field], dt.strptime(nwc_time, "%Y%m%d%H%M"))
+    tstm = [synthetic_field(ny, nx, shift=(i, 2 * i), scale=100.0) for i in range(n_leadtimes)]
+    write_synthetic_grib(os.path.join(data_root, start_time, "mnwc_tstm.grib2"), tstm, analysis_time)
+    flash_dir = os.path.join(workdir, "flashes")
+    flashes = synthetic_flashes(analysis_time)
+    FlashArchive(flash_dir).append(flashes, analysis_time - td(hours=1), analysis_time + td(minutes=1))
+    return data_root, flash_dir
+
+
+def synthetic_field(ny: int, nx: int, shift: tuple, scale: float, seed: int = 1) -> np.array:
+    """Sum of gaussian blobs, shifted by (dy, dx) pixels"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:ny, 0:nx]
+    field = np.zeros((ny, nx))
+    for cy, cx, r in zip(rng.uniform(0, ny, 8), rng.uniform(0, nx, 8), rng.uniform(0.02, 0.08, 8) * min(ny, nx)):
+        field += np.exp(-((y - cy - shift[0]) ** 2 + (x - cx - shift[1]) ** 2) / (2 * r ** 2))
+    return np.clip(field, 0, 1) * scale
+
+
+def synthetic_flashes(analysis_time: dt, n_clusters: int = 5, per_cluster: int = 200, seed: int = 1) -> pd.DataFrame:
+    """Clusters of flashes during the hour before analysis_time, in smartmet columns"""
+    rng = np.random.default_rng(seed)
+    n = n_clusters * per_cluster
+    centers_lat = rng.uniform(LAT_RANGE[0] + 2, LAT_RANGE[1] - 2, n_clusters)
+    centers_lon = rng.uniform(LON_RANGE[0] + 2, LON_RANGE[1] - 2, n_clusters)
+    return pd.DataFrame({"flash_id": np.arange(n),
+                         "longitude": np.repeat(centers_lon, per_cluster) + rng.normal(0, 0.2, n),
+                         "latitude": np.repeat(centers_lat, per_cluster) + rng.normal(0, 0.1, n),
+                         "utctime": np.sort(rng.integers(epoch(analysis_time - td(hours=1)), epoch(analysis_time), n)),
+                         "altitude": np.zeros(n),
+                         "peak_current": rng.normal(0, 20, n)})
+
+
+def write_synthetic_grib(path: str, fields: list, analysis_time: dt):
+    """Write fields as 15 min lead times of a regular lat-lon grib2 file"""
+    ny, nx = fields[0].shape
+    with open(path, "wb") as fp:
+        for i, field in enumerate(fields):
+            gh = codes_grib_new_from_samples("regular_ll_sfc_grib2")
+            codes_set_long(gh, "Ni", nx)
+            codes_set_long(gh, "Nj", ny)
+            codes_set(gh, "latitudeOfFirstGridPointInDegrees", LAT_RANGE[1])
+            codes_set(gh, "latitudeOfLastGridPointInDegrees", LAT_RANGE[0])
+            codes_set(gh, "longitudeOfFirstGridPointInDegrees", LON_RANGE[0])
+            codes_set(gh, "longitudeOfLastGridPointInDegrees", LON_RANGE[1])
+            codes_set(gh, "iDirectionIncrementInDegrees", (LON_RANGE[1] - LON_RANGE[0]) / (nx - 1))
+            codes_set(gh, "jDirectionIncrementInDegrees", (LAT_RANGE[1] - LAT_RANGE[0]) / (ny - 1))
+            codes_set_long(gh, "dataDate", int(analysis_time.strftime("%Y%m%d")))
+            codes_set_long(gh, "dataTime", int(analysis_time.strftime("%H%M")))
+            codes_set_long(gh, "indicatorOfUnitOfTimeRange", 0)
+            codes_set_long(gh, "forecastTime", 15 * i)
+            codes_set_long(gh, "bitsPerValue", 16)
+            codes_set_values(gh, field.flatten())
+            codes_write(gh, fp)
+            codes_release(gh)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("--sizes", action="store", type=str, nargs="+", default=["256x256", "512x512", "1024x1024"],
+                        help="Grid sizes as NYxNX")
+    parser.add_argument("--start_time", action="store", type=str, default="202307011200")
+    parser.add_argument("--repeat", action="store", type=int, default=3)
+    parser.add_argument("--workdir", action="store", type=str, default=None)
+    parser.add_argument("--output", action="store", type=str, default="benchmark.json")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    main()
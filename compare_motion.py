@@ -0,0 +1,31 @@
+import argparse
+import json
+import tools as tl
+from frame_store import FrameStore
+
+
+def main():
+    """Compare coarse resolution motion fields against the full resolution field
+
+    Helps to pick the largest --motion_factor that still keeps the motion field close
+    to the full resolution one.
+    """
+    args = parse_command_line()
+    files = tl.validate_and_sort_filenames(args.rprate_files)
+    store = FrameStore(max_frames=len(files))
+    frames = [store.read(f) for f in files]
+    nwc_data = tl.stack_frames(frames)
+    result = tl.compare_motion_fields(nwc_data.data, None, args.factors)
+    print(json.dumps(result, indent=2))
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("--rprate_files", action="store", type=str, nargs="+", required=True)
+    parser.add_argument("--factors", action="store", type=int, nargs="+", default=[2, 4, 8])
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    main()
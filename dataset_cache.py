@@ -0,0 +1,199 @@
+import os
+import collections
+import numpy as np
+from dataclasses import dataclass
+from eccodes import (codes_grib_new_from_file, codes_new_from_message, codes_get_long, codes_get_values,
+                     codes_get_message_offset, codes_release)
+from tools import read_file_from_s3, prefetched_file, s3_filesystem, S3_READER
+from grid_cache import GridCache
+from grib_index import GribIndex, read_leadtime
+
+
+@dataclass
+class DecodedMessage:
+    """Values and metadata of one decoded grib message, values are shared and read-only"""
+    values: np.array
+    leadtime: object
+    data_date: int
+    data_time: int
+    grid_hash: str
+    all_missing: bool
+
+
+class Dataset:
+    """Decoded messages of one grib file by their position in the file
+
+    Messages are decoded only when some reader first asks for them, so a later reader
+    needing more lead times decodes only the missing ones. Byte offsets of scanned
+    messages are kept, so single messages (e.g. templates) can be re-read without
+    keeping the encoded messages in memory.
+    """
+    def __init__(self, data_file: str, slot=None):
+        self.data_file = data_file
+        # With slot(position, capacity, nj, ni) values are decoded into arrays owned by the caller
+        # instead of being kept here, see ReadData.slot
+        self.slot = slot
+        self.capacity = 0
+        self.local_file = None if data_file.startswith("s3://") else data_file
+        self.messages = {}
+        self.grib_index = None
+        # (offset, length) of messages scanned so far, all of them once the index is known
+        self.offsets = []
+        self.complete = False
+        self.nbytes = 0
+
+    def read_sequential(self, count: int) -> list:
+        """Positions of the first count messages of the file, or of all if there are fewer"""
+        if self.complete:
+            count = min(count, len(self.offsets))
+        self.capacity = count
+        if any(p not in self.messages for p in range(count)):
+            self.scan(count)
+        return [p for p in range(count) if p in self.messages]
+
+    def read_indexed(self, leadtimes: list = None, params: list = None) -> list:
+        """Positions of messages with lead time (minutes) in leadtimes and shortName in params
+
+        Without params only the first message of each lead time is selected, like the
+        sequential reader would, instead of every parameter of multi-parameter files.
+        """
+        index = self.index()
+        selected = index.select(leadtimes, params)
+        positions = [p for p, e in enumerate(index.entries) if e in selected]
+        if params is None:
+            first = {}
+            for p in positions:
+                first.setdefault(index.entries[p]["leadtime"], p)
+            positions = sorted(first.values())
+        missing = [p for p in positions if p not in self.messages]
+        self.capacity = len(missing)
+        if self.local_file is None:
+            for p in missing:
+                self.decode(p, codes_new_from_message(self.read_message(p)))
+        elif len(missing) > 0:
+            with open(self.local_file, "rb") as fp:
+                for p in missing:
+                    offset, length = self.offsets[p]
+                    fp.seek(offset)
+                    self.decode(p, codes_new_from_message(fp.read(length)))
+        return positions
+
+    def index(self) -> GribIndex:
+        """Message index from the S3 sidecar, or of the local (downloaded) file"""
+        if self.grib_index is not None:
+            return self.grib_index
+        if self.local_file is None:
+            fs = s3_filesystem()
+            if fs.exists(self.data_file + ".idx"):
+                index = GribIndex.from_json(fs.cat_file(self.data_file + ".idx").decode())
+            else:
+                self.local_file = read_file_from_s3(self.data_file)
+                index = GribIndex.for_file(self.local_file)
+        else:
+            index = GribIndex.for_file(self.local_file)
+        self.offsets = [(e["offset"], e["length"]) for e in index.entries]
+        self.complete = True
+        self.grib_index = index
+        return index
+
+    def scan(self, count: int):
+        """Decode messages sequentially up to position count, starting from the first missing one"""
+        if self.local_file is None:
+            self.local_file = prefetched_file(self.data_file) or S3_READER.cached(self.data_file)
+            if self.local_file is None:
+                self.stream(count)
+                return
+        start = min(p for p in range(count) if p not in self.messages)
+        if start < len(self.offsets):
+            offset = self.offsets[start][0]
+        elif len(self.offsets) > 0:
+            offset = sum(self.offsets[-1])
+        else:
+            offset = 0
+        with open(self.local_file, "rb") as fp:
+            fp.seek(offset)
+            for p in range(start, count):
+                gh = codes_grib_new_from_file(fp)
+                if gh is None:
+                    self.complete = True
+                    break
+                if p == len(self.offsets):
+                    self.offsets.append((codes_get_message_offset(gh), codes_get_long(gh, "totalLength")))
+                if p in self.messages:
+                    codes_release(gh)
+                else:
+                    self.decode(p, gh)
+
+    def stream(self, count: int):
+        """Decode messages up to position count while the S3 object is being transferred
+
+        The rest of the object is read only into the S3 cache, which is then used as the local file.
+        """
+        for p, (offset, message) in enumerate(S3_READER.messages(self.data_file)):
+            if p == len(self.offsets):
+                self.offsets.append((offset, len(message)))
+            if p < count and p not in self.messages:
+                self.decode(p, codes_new_from_message(message))
+        self.complete = True
+        self.local_file = S3_READER.cached(self.data_file)
+
+    def decode(self, position: int, gh):
+        """Decode and release message gh"""
+        ni = codes_get_long(gh, "Ni")
+        nj = codes_get_long(gh, "Nj")
+        values = np.asarray(codes_get_values(gh)).reshape(nj, ni)
+        if self.slot is not None:
+            target = self.slot(position, self.capacity, nj, ni)
+            target[...] = values
+            values = target
+        else:
+            values.setflags(write=False)
+            self.nbytes += values.nbytes
+        self.messages[position] = DecodedMessage(values, read_leadtime(gh), codes_get_long(gh, "dataDate"),
+                                                 codes_get_long(gh, "dataTime"), GridCache.grid_hash(gh),
+                                                 codes_get_long(gh, "numberOfMissing") == ni * nj)
+        codes_release(gh)
+
+    def read_message(self, position: int) -> bytes:
+        """Encoded message at position, by its byte offset"""
+        offset, length = self.offsets[position]
+        if self.local_file is None:
+            return S3_READER.read_range(self.data_file, offset, offset + length)
+        with open(self.local_file, "rb") as fp:
+            fp.seek(offset)
+            return fp.read(length)
+
+    def handle(self, position: int):
+        """New grib handle of message at position, to be released by the caller"""
+        return codes_new_from_message(self.read_message(position))
+
+
+class DatasetCache:
+    """Per-process cache of decoded grib files
+
+    Readers of the same file, e.g. Analysis reading the 0h MNWC field and the fallback
+    reading all lead times of it, share decoded messages instead of downloading and
+    decoding the file again. Values are limited to max_bytes, least recently used files
+    are dropped first. Local files are keyed also by modification time. Readers with
+    a dtype (low memory mode) bypass the cache and decode into their own buffers.
+    """
+    def __init__(self, max_bytes: int = 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.datasets = collections.OrderedDict()
+
+    def get(self, data_file: str) -> Dataset:
+        key = data_file if data_file.startswith("s3://") else (data_file, os.path.getmtime(data_file))
+        if key not in self.datasets:
+            self.datasets[key] = Dataset(data_file)
+        self.datasets.move_to_end(key)
+        return self.datasets[key]
+
+    def evict(self):
+        """Drop least recently used files until cached values fit to max_bytes"""
+        total = sum(d.nbytes for d in self.datasets.values())
+        while total > self.max_bytes and len(self.datasets) > 0:
+            key, dataset = self.datasets.popitem(last=False)
+            total -= dataset.nbytes
+
+    def clear(self):
+        self.datasets.clear()
@@ -1,14 +1,27 @@
 from eccodes import *
 import sys
-import time
 import datetime
+import tempfile
 import numpy as np
+import xarray as xr
 import os
 import fsspec
-from tools import read_file_from_s3, mask_missing_data
-import gc
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tools import mask_missing_data
+from grid_cache import GridCache
+from dataset_cache import DatasetCache, Dataset
+from s3_upload import S3UploadSink
+from telemetry import span, describe_array
 
 GRIB_MESSAGE_STEP = None
+# Grid coordinates are cached per process, and on local disk if THUNDERCAST_GRID_CACHE_DIR is set
+GRID_CACHE = GridCache(os.environ.get("THUNDERCAST_GRID_CACHE_DIR"),
+                       int(os.environ.get("THUNDERCAST_GRID_CACHE_MAX_MB", 2048)) * 1024 ** 2)
+# Output packings by --packing name
+PACKING_TYPES = {"simple": "grid_simple", "ccsds": "grid_ccsds", "jpeg": "grid_jpeg"}
+# Decoded grib files are shared by readers of the same process, see DatasetCache
+DATASET_CACHE = DatasetCache(int(os.environ.get("THUNDERCAST_DATASET_CACHE_MAX_MB", 1024)) * 1024 ** 2)
 
 
 class ReadData:
@@ -16,97 +29,127 @@ class ReadData:
                  added_hours: int = 0,
                  time_steps: int = 0,
                  read_coordinates: bool = False,
-                 use_as_template: bool = False):
+                 use_as_template: bool = False,
+                 leadtimes: list = None,
+                 params: list = None,
+                 dtype=None):
         self.data_file = data_file
+        # With dtype fields are decoded straight into one preallocated array of that type
+        self.dtype = dtype
+        self.buffer = None
+        self.capacity = 0
+        self.n_slots = 0
         self.mask_nodata = None
         self.data = None
         self.nodata = 9999
         self.latitudes = None
         self.longitudes = None
         self.template = None
+        self.grid_hash = None
         self.dtime = None
         self.forecast_time = None
         self.analysis_time = None
-        self.read(added_hours, read_coordinates, use_as_template, time_steps)
+        self.read(added_hours, read_coordinates, use_as_template, time_steps, leadtimes, params)
 
-    def read(self, added_hours, read_coordinates, use_as_template, time_steps):
+    @property
+    def mask_nodata(self):
+        """Masked array of data, built only when first needed"""
+        if self._mask_nodata is None and self.data is not None:
+            self._mask_nodata = np.ma.masked_where(self.data == self.nodata, self.data)
+        return self._mask_nodata
+
+    @mask_nodata.setter
+    def mask_nodata(self, value):
+        self._mask_nodata = value
+
+    def read(self, added_hours, read_coordinates, use_as_template, time_steps, leadtimes=None, params=None):
         print(f"Reading {self.data_file}")
         if self.data_file.endswith(".grib2"):
-            self.read_grib(added_hours, read_coordinates, use_as_template, time_steps)
+            with span("read", file=self.data_file) as record:
+                if leadtimes is not None or params is not None:
+                    self.read_grib_indexed(added_hours, read_coordinates, use_as_template, leadtimes, params)
+                else:
+                    self.read_grib(added_hours, read_coordinates, use_as_template, time_steps)
+                describe_array(record, self.data)
         else:
             sys.exit("unsupported file type for file: %s" % (self.data_file))
 
+    def dataset(self):
+        if self.dtype is None:
+            return DATASET_CACHE.get(self.data_file)
+        # Low memory mode decodes straight into the buffer of this reader and caches nothing
+        return Dataset(self.data_file, slot=self.slot)
+
+    def slot(self, position, capacity, nj, ni):
+        """Next free field of the preallocated buffer, for decoding message at position"""
+        if self.buffer is None:
+            self.capacity = capacity
+            self.buffer = np.empty((capacity, nj, ni), dtype=self.dtype)
+            self.n_slots = 0
+        self.n_slots += 1
+        return self.buffer[self.n_slots - 1]
+
     def read_grib(self, added_hours, read_coordinates, use_as_template, time_steps):
-        global GRIB_MESSAGE_STEP
-        start = time.time()
+        dataset = self.dataset()
+        positions = dataset.read_sequential(time_steps + 1)
+        self.read_messages(dataset, positions, added_hours, read_coordinates, use_as_template)
 
-        def read_leadtime(gh):
-            tr = codes_get_long(gh, "indicatorOfUnitOfTimeRange")
-            ft = codes_get_long(gh, "forecastTime")
-            if tr == 1:
-                return datetime.timedelta(hours=ft)
-            if tr == 0:
-                return datetime.timedelta(minutes=ft)
-            raise Exception("Unknown indicatorOfUnitOfTimeRange: {:%d}".format(tr))
+    def read_grib_indexed(self, added_hours, read_coordinates, use_as_template, leadtimes, params):
+        """Decode only messages with given lead times (minutes) and parameters
 
+        Message offsets come from GribIndex. S3 files with a <file>.idx sidecar are read
+        with byte range requests, otherwise the whole file is fetched and scanned.
+        """
+        dataset = self.dataset()
+        positions = dataset.read_indexed(leadtimes, params)
+        if len(positions) == 0:
+            raise ValueError(f"No messages with leadtimes {leadtimes} and params {params} in {self.data_file}")
+        self.read_messages(dataset, positions, added_hours, read_coordinates, use_as_template)
+
+    def read_messages(self, dataset, positions, added_hours, read_coordinates, use_as_template):
+        """Copy decoded messages at positions of dataset to data, template is the last message read"""
+        global GRIB_MESSAGE_STEP
         data_ls = []
-        latitudes_ls = []
-        longitudes_ls = []
         dtime_ls = []
-        wrk_data_file = self.data_file
-
-        if self.data_file.startswith("s3://"):
-            wrk_data_file = read_file_from_s3(self.data_file)
-
-        i = 0
-        with open(wrk_data_file) as fp:
-            while True:
-                gh = codes_grib_new_from_file(fp)
-                if gh is None:
-                    break
-
-                ni = codes_get_long(gh, "Ni")
-                nj = codes_get_long(gh, "Nj")
-                data_date = codes_get_long(gh, "dataDate")
-                data_time = codes_get_long(gh, "dataTime")
-                lt = read_leadtime(gh)
-                self.analysis_time = datetime.datetime.strptime("{:d}/{:04d}".format(data_date, data_time), "%Y%m%d/%H%M")
-                self.forecast_time = datetime.datetime.strptime("{:d}/{:04d}".format(data_date, data_time), "%Y%m%d/%H%M") + lt
-                dtime_ls.append(self.forecast_time)
-                values = np.asarray(codes_get_values(gh))
-                data_ls.append(values.reshape(nj, ni))
-                if read_coordinates and i == 0:
-                    latitudes_ls.append(np.asarray(codes_get_array(gh, "latitudes").reshape(nj, ni)))
-                    longitudes_ls.append(np.asarray(codes_get_array(gh, "longitudes").reshape(nj, ni)))
-
-                if use_as_template:
-                    self.template = codes_clone(gh)
-                    if GRIB_MESSAGE_STEP is None and lt > datetime.timedelta(minutes=0):
-                        GRIB_MESSAGE_STEP = lt
-                if codes_get_long(gh, "numberOfMissing") == ni*nj:
-                    print("File {} leadtime {} contains only missing data!".format(self.data_file, lt))
-                    sys.exit(1)
-                codes_release(gh)
-
-                if len(dtime_ls) > time_steps:
-                    fp.close()
-                    del fp
-                    del gh
-                    gc.collect()
-                    break
-                i += 1
-
-        self.data = np.asarray(data_ls)
-        if len(latitudes_ls) > 0:
-            self.latitudes = np.asarray(latitudes_ls)
-            self.longitudes = np.asarray(longitudes_ls)
-            self.latitudes = self.latitudes[0, :, :]
-            self.longitudes = self.longitudes[0, :, :]
-
-        self.mask_nodata = np.ma.masked_where(self.data == self.nodata, self.data)
+        for p in positions:
+            message = dataset.messages[p]
+            nj, ni = message.values.shape
+            lt = message.leadtime
+            self.analysis_time = datetime.datetime.strptime("{:d}/{:04d}".format(message.data_date, message.data_time),
+                                                            "%Y%m%d/%H%M")
+            self.forecast_time = self.analysis_time + lt
+            dtime_ls.append(self.forecast_time)
+            # Cached values are read-only and stacked to a new array in set_data,
+            # with dtype values are fields of self.buffer already
+            data_ls.append(message.values)
+            if use_as_template and GRIB_MESSAGE_STEP is None and lt > datetime.timedelta(minutes=0):
+                GRIB_MESSAGE_STEP = lt
+            if message.all_missing:
+                print("File {} leadtime {} contains only missing data!".format(self.data_file, lt))
+                sys.exit(1)
+
+        if len(positions) > 0:
+            self.grid_hash = dataset.messages[positions[0]].grid_hash
+            if read_coordinates:
+                if self.grid_hash in GRID_CACHE.coordinates:
+                    self.latitudes, self.longitudes = GRID_CACHE.coordinates[self.grid_hash]
+                else:
+                    gh = dataset.handle(positions[0])
+                    self.latitudes, self.longitudes = GRID_CACHE.read_coordinates(gh, ni, nj, self.grid_hash)
+                    codes_release(gh)
+            if use_as_template:
+                self.template = dataset.handle(positions[-1])
+        self.set_data(data_ls, dtime_ls, added_hours)
+        DATASET_CACHE.evict()
+
+    def set_data(self, data_ls, dtime_ls, added_hours):
+        if self.buffer is not None:
+            # View of decoded part of the buffer, no copy
+            self.data = self.buffer[:len(data_ls)]
+        else:
+            self.data = np.asarray(data_ls)
         if type(dtime_ls) == list:
             self.dtime = [(i+datetime.timedelta(hours=added_hours)) for i in dtime_ls]
-        print("Read {} in {:.2f} seconds".format(self.data_file, time.time() - start))
 
 
 class WriteData:
@@ -114,73 +157,218 @@ class WriteData:
                  input_meta,
                  output_file: str,
                  write_option: str,
-                 t_diff: int = 0):
-        self.interpolated_data = interpolated_data.data
+                 t_diff: int = 0,
+                 encode_workers: int = 1,
+                 encode_executor: str = "process",
+                 packing: str = "simple",
+                 bits_per_value: int = 24,
+                 chunked_output: str = None):
+        # Either an object with (n_leadtimes, ny, nx) data or an iterable of 2D fields,
+        # e.g. ExtrapolatedNWC.leadtimes(), which are written as soon as they are ready
+        if isinstance(interpolated_data, np.ndarray) or not hasattr(interpolated_data, "data"):
+            self.interpolated_data = interpolated_data
+        else:
+            self.interpolated_data = interpolated_data.data
         self.t_diff = t_diff
         self.write_option = write_option
+        self.encode_workers = encode_workers
+        self.encode_executor = encode_executor
+        self.packing = packing
+        self.bits_per_value = bits_per_value
+        # NetCDF4 (.nc) or Zarr (.zarr) copy of the output, written next to the grib
+        self.chunked_output = chunked_output
         self.template = input_meta
+        # Future of the background upload in s3 mode
+        self.upload = None
         self.write(output_file)
 
     def write(self, output_file):
         if self.write_option == "s3":
-            endpoint_url = os.environ.get("S3_HOSTNAME", "https://routines-data.lake.fmi.fi")
-            openfile = fsspec.open(
-                "simplecache::{}".format(output_file),
-                "wb",
-                s3={
-                    "anon": False,
-                    "key": os.environ["S3_ACCESS_KEY_ID"],
-                    "secret": os.environ["S3_SECRET_ACCESS_KEY"],
-                    "client_kwargs": {"endpoint_url": endpoint_url},
-                },
-            )
-            with openfile as fpout:
+            # Messages are uploaded in the background while encoding, and the upload
+            # finishes after this returns, see self.upload and s3_upload.wait_for_uploads
+            fpout = S3UploadSink(output_file, s3_write_options())
+            try:
                 self.write_grib_message(fpout)
+            except BaseException:
+                fpout.abort()
+                raise
+            fpout.close()
+            self.upload = fpout.upload
+            print("uploading file '%s'" % output_file)
         else:
             with open(output_file, "wb") as fpout:
                 self.write_grib_message(fpout)
-        print("wrote file '%s'" % output_file)
+            print("wrote file '%s'" % output_file)
 
     def write_grib_message(self, fp):
+        with span("encoding") as record:
+            record["messages"] = self.encode_grib_messages(fp)
+
+    def encode_grib_messages(self, fp):
         dataDate = int(codes_get_long(self.template, "dataDate"))
         dataTime = int(codes_get_long(self.template, "dataTime"))
         analysistime = datetime.datetime.strptime("{}{:04d}".format(dataDate, dataTime), "%Y%m%d%H%M")
         analysistime = analysistime + datetime.timedelta(hours=self.t_diff)
         codes_set_long(self.template, "dataDate", int(analysistime.strftime("%Y%m%d")))
         codes_set_long(self.template, "dataTime", int(analysistime.strftime("%H%M")))
-        codes_set_long(self.template, "bitsPerValue", 24)
+        codes_set_string(self.template, "packingType", PACKING_TYPES[self.packing])
+        codes_set_long(self.template, "bitsPerValue", self.bits_per_value)
         codes_set_long(self.template, "generatingProcessIdentifier", 202)
         codes_set_long(self.template, "centre", 86)
         codes_set_long(self.template, "bitmapPresent", 1)
         codes_set_long(self.template, "indicatorOfUnitOfTimeRange", 0)  # minute
         codes_set_long(self.template, "stepUnits", 1)  # minute
-        base_lt = datetime.timedelta(minutes=15)
-        pdtn = codes_get_long(self.template, "productDefinitionTemplateNumber")
-        for i in range(self.interpolated_data.shape[0]):
-            lt = base_lt * i
+        n_messages = 0
+        fields = self.interpolated_data
+        chunked = None
+        if self.chunked_output is not None:
+            chunked = ChunkedWriter(self.chunked_output, self.template, analysistime)
+            fields = chunked.tee(fields)
+        if self.encode_workers > 1:
+            n_messages = self.write_grib_message_parallel(fp, analysistime, fields)
+        else:
+            for i, field in enumerate(fields):
+                set_leadtime(self.template, i, analysistime)
+                codes_set_values(self.template, field.flatten())
+                codes_write(self.template, fp)
+                fp.flush()
+                n_messages += 1
 
-            if pdtn == 8:
-                lt -= base_lt
+        print("")
+        if chunked is not None:
+            chunked.close()
+        codes_release(self.template)
+        #fp.close()
+        return n_messages
 
-                tr = codes_get_long(self.template, "indicatorOfUnitForTimeRange")
-                trlen = codes_get_long(self.template, "lengthOfTimeRange")
+    def write_grib_message_parallel(self, fp, analysistime, fields):
+        """Encode lead times in a pool, each from its own copy of the template
 
-                assert ((tr == 1 and trlen == 1) or (tr == 0 and trlen == 60))
-                lt_end = analysistime + datetime.timedelta(
-                    hours=codes_get_long(self.template, "lengthOfTimeRange"))
+        Messages are written in lead time order. At most two messages per worker are
+        pending at a time, so a streamed input is not read into memory all at once.
+        """
+        template_message = codes_get_message(self.template)
+        # eccodes is not built thread safe everywhere, threads are used only when asked for
+        executor_class = ProcessPoolExecutor if self.encode_executor == "process" else ThreadPoolExecutor
+        pending = collections.deque()
+        i = -1
+        with executor_class(max_workers=self.encode_workers) as executor:
+            for i, field in enumerate(fields):
+                pending.append(executor.submit(encode_grib_message, template_message, field, i, analysistime))
+                if len(pending) >= 2 * self.encode_workers:
+                    fp.write(pending.popleft().result())
+                    fp.flush()
+            while len(pending) > 0:
+                fp.write(pending.popleft().result())
+                fp.flush()
+        return i + 1
 
-                # these are not mandatory but some software uses them
-                codes_set_long(self.template, "yearOfEndOfOverallTimeInterval", int(lt_end.strftime("%Y")))
-                codes_set_long(self.template, "monthOfEndOfOverallTimeInterval", int(lt_end.strftime("%m")))
-                codes_set_long(self.template, "dayOfEndOfOverallTimeInterval", int(lt_end.strftime("%d")))
-                codes_set_long(self.template, "hourOfEndOfOverallTimeInterval", int(lt_end.strftime("%H")))
-                codes_set_long(self.template, "minuteOfEndOfOverallTimeInterval", int(lt_end.strftime("%M")))
-                codes_set_long(self.template, "secondOfEndOfOverallTimeInterval", int(lt_end.strftime("%S")))
 
-            codes_set_long(self.template, "forecastTime", lt.total_seconds() / 60)
-            codes_set_values(self.template, self.interpolated_data[i, :, :].flatten())
-            codes_write(self.template, fp)
+class ChunkedWriter:
+    """Output fields as a NetCDF4 (.nc) or Zarr (.zarr) dataset with one lead time per chunk
 
-        print("")
-        codes_release(self.template)
-        #fp.close()
+    Zarr stores are appended one lead time at a time. NetCDF files are written when
+    closed, so fields of a streamed input are kept in memory until then.
+    """
+    def __init__(self, output_file: str, template, analysistime: datetime.datetime):
+        self.output_file = output_file
+        self.zarr = output_file.rstrip("/").endswith(".zarr")
+        self.analysistime = analysistime
+        ni = codes_get_long(template, "Ni")
+        nj = codes_get_long(template, "Nj")
+        self.latitudes, self.longitudes = GRID_CACHE.read_coordinates(template, ni, nj)
+        self.fields = []
+        self.n_fields = 0
+
+    def tee(self, fields):
+        """Pass fields through, adding each one to the dataset"""
+        for field in fields:
+            self.add(field)
+            yield field
+
+    def add(self, field):
+        field = np.asarray(field, dtype=np.float32)[np.newaxis]
+        if self.zarr:
+            storage_options = s3_write_options() if self.output_file.startswith("s3://") else None
+            if self.n_fields == 0:
+                self.dataset(field).to_zarr(self.output_file, mode="w", storage_options=storage_options,
+                                            encoding={"pot": {"chunks": field.shape}})
+            else:
+                self.dataset(field).drop_vars(["latitude", "longitude"]).to_zarr(
+                    self.output_file, append_dim="time", storage_options=storage_options)
+        else:
+            self.fields.append(field)
+        self.n_fields += 1
+
+    def close(self):
+        if not self.zarr and len(self.fields) > 0:
+            data = np.concatenate(self.fields)
+            self.fields = []
+            dataset = self.dataset(data, 0)
+            encoding = {"pot": {"chunksizes": (1,) + data.shape[1:], "zlib": True}}
+            if self.output_file.startswith("s3://"):
+                with tempfile.NamedTemporaryFile(suffix=".nc") as tmp:
+                    dataset.to_netcdf(tmp.name, encoding=encoding)
+                    fsspec.filesystem("s3", **s3_write_options()).put(tmp.name, self.output_file)
+            else:
+                dataset.to_netcdf(self.output_file, encoding=encoding)
+        print("wrote file '%s'" % self.output_file)
+
+    def dataset(self, data: np.array, start: int = None) -> xr.Dataset:
+        start = self.n_fields if start is None else start
+        times = [self.analysistime + datetime.timedelta(minutes=15) * (start + i) for i in range(len(data))]
+        return xr.Dataset({"pot": (("time", "y", "x"), data,
+                                   {"long_name": "Probability of thunder", "units": "%"})},
+                          coords={"time": times,
+                                  "latitude": (("y", "x"), np.asarray(self.latitudes)),
+                                  "longitude": (("y", "x"), np.asarray(self.longitudes))},
+                          attrs={"analysis_time": self.analysistime.isoformat()})
+
+
+def s3_write_options() -> dict:
+    """fsspec options for writing to S3 with credentials from the environment"""
+    endpoint_url = os.environ.get("S3_HOSTNAME", "https://routines-data.lake.fmi.fi")
+    return {
+        "anon": False,
+        "key": os.environ["S3_ACCESS_KEY_ID"],
+        "secret": os.environ["S3_SECRET_ACCESS_KEY"],
+        "client_kwargs": {"endpoint_url": endpoint_url},
+    }
+
+
+def set_leadtime(gh, i, analysistime):
+    """Set keys of i:th 15 min lead time to grib message gh"""
+    base_lt = datetime.timedelta(minutes=15)
+    pdtn = codes_get_long(gh, "productDefinitionTemplateNumber")
+    lt = base_lt * i
+
+    if pdtn == 8:
+        lt -= base_lt
+
+        tr = codes_get_long(gh, "indicatorOfUnitForTimeRange")
+        trlen = codes_get_long(gh, "lengthOfTimeRange")
+
+        assert ((tr == 1 and trlen == 1) or (tr == 0 and trlen == 60))
+        lt_end = analysistime + datetime.timedelta(
+            hours=codes_get_long(gh, "lengthOfTimeRange"))
+
+        # these are not mandatory but some software uses them
+        codes_set_long(gh, "yearOfEndOfOverallTimeInterval", int(lt_end.strftime("%Y")))
+        codes_set_long(gh, "monthOfEndOfOverallTimeInterval", int(lt_end.strftime("%m")))
+        codes_set_long(gh, "dayOfEndOfOverallTimeInterval", int(lt_end.strftime("%d")))
+        codes_set_long(gh, "hourOfEndOfOverallTimeInterval", int(lt_end.strftime("%H")))
+        codes_set_long(gh, "minuteOfEndOfOverallTimeInterval", int(lt_end.strftime("%M")))
+        codes_set_long(gh, "secondOfEndOfOverallTimeInterval", int(lt_end.strftime("%S")))
+
+    codes_set_long(gh, "forecastTime", lt.total_seconds() / 60)
+
+
+def encode_grib_message(template_message, field, i, analysistime):
+    """Encode one lead time from template message bytes, return encoded message bytes"""
+    gh = codes_new_from_message(template_message)
+    try:
+        set_leadtime(gh, i, analysistime)
+        codes_set_values(gh, field.flatten())
+        return codes_get_message(gh)
+    finally:
+        codes_release(gh)
@@ -1,121 +1,152 @@
+import hashlib
 import gridpp
-import numpy as np
 import requests
-import pandas as pd
+import numpy as np
 import tools as tl
-from datetime import datetime as dt
+from concurrent.futures import Future
 from file_utils import ReadData
+from flash_obs import FLASH_CLIENT
+from telemetry import span, describe_array
+
+# Analysis contexts of already seen model grids, keyed by grid hash
+ANALYSIS_CONTEXTS = {}
+
+
+def coordinates_hash(latitudes, longitudes) -> str:
+    """Key of a grid given as coordinate arrays, for ANALYSIS_CONTEXTS"""
+    md5 = hashlib.md5()
+    md5.update(np.ascontiguousarray(latitudes))
+    md5.update(np.ascontiguousarray(longitudes))
+    return md5.hexdigest()
+
+
+class AnalysisContext:
+    """Observation independent part of the analysis for a fixed model grid
+
+    Holds gridpp.Grid (and so its spatial index) and the structure function,
+    which can be reused over consecutive cycles in the same process.
+    """
+    def __init__(self, latitudes, longitudes):
+        topo = np.zeros(latitudes.shape)
+        self.grid = gridpp.Grid(latitudes, longitudes, topo)
+        self.structure = gridpp.BarnesStructure(20500, 200)
+
+
+def get_analysis_context(data):
+    """Return cached AnalysisContext for grid of data, creating it on first use"""
+    if data.grid_hash not in ANALYSIS_CONTEXTS:
+        ANALYSIS_CONTEXTS[data.grid_hash] = AnalysisContext(data.latitudes, data.longitudes)
+    return ANALYSIS_CONTEXTS[data.grid_hash]
 
 
 class Analysis:
-    def __init__(self, origin_file, obs_time, time_window):
-        self.obs = None
+    """0h POT analysis, optimal interpolation of flash observations to MNWC tstm background
+
+    Background is read from origin_file, or given as a 2D array with its coordinates,
+    in which case the array is not modified. obs can also be a Future of a flash query
+    started earlier, it is waited for in read_obs.
+    """
+    def __init__(self, origin_file=None, obs_time=None, time_window=None, obs=None, dtype=None,
+                 background=None, latitudes=None, longitudes=None):
+        self.obs = obs
+        self.dtype = dtype
         self.points = None
         self.output = None
-        self.longitudes = None
-        self.latitudes = None
+        self.longitudes = longitudes
+        self.latitudes = latitudes
+        self.grid_hash = None
+        self.background = None
         self.template = None
+        self.context = None
         self.origin_file = origin_file
         self.obs_time = obs_time
         self.time_window = time_window
+        if background is not None:
+            self.background = self.limit_background(tl.clean_nodata(np.array(background, dtype=float)))
+            self.grid_hash = coordinates_hash(latitudes, longitudes)
         self.generate_analysis_field()
 
     def generate_analysis_field(self):
         try:
             print("Reading observation data")
             self.points, self.obs = self.read_obs()
-            data = ReadData(self.origin_file, read_coordinates=True, use_as_template=True)
-            data.data = tl.mask_missing_data(data.data, data.mask_nodata)
-            self.template = data.template
-            self.generate_background_params(data)
-            grid = self.read_grid(data)
-            background = self.get_background_data(data)
-            self.output = self.interpolate(grid, background, 'flash')
-        except ValueError as e:
+            if self.background is None:
+                self.read_background()
+            self.context = get_analysis_context(self)
+            grid = self.read_grid(self)
+            self.output = self.interpolate(grid, self.background, 'flash')
+        except (ValueError, requests.RequestException) as e:
             raise KeyError("Use MNWC origin data for thundercast")
         except FileNotFoundError as f:
             raise KeyError("No MNWC tstm-file to use as base data")
 
+    def read_background(self):
+        # Only the 0h field is needed, decode it directly via the message index
+        data = ReadData(self.origin_file, read_coordinates=True, use_as_template=True, leadtimes=[0],
+                        dtype=self.dtype)
+        if self.dtype is None:
+            data.data = tl.mask_missing_data(data.data, data.mask_nodata)
+        else:
+            data.data = tl.clean_nodata(data.data)
+        self.template = data.template
+        self.grid_hash = data.grid_hash
+        self.generate_background_params(data)
+        self.background = self.get_background_data(data)
 
     @staticmethod
     def get_background_data(data):
-        background = data.data[0]
+        return Analysis.limit_background(data.data[0])
+
+    @staticmethod
+    def limit_background(background):
         background[background > 100] = 100
         background[background < 10] = 0
         return background
 
     def read_grid(self, data):
         """Top function to read all gridded data"""
+        if self.context is not None:
+            return self.context.grid
         topo = np.zeros(data.longitudes.shape)
         grid = gridpp.Grid(data.latitudes, data.longitudes, topo)
         return grid
 
     def read_obs(self):
-        """Read observations from smartmet server"""
-        obs = self.read_flash_obs()
+        """Read observations from smartmet server, unless those are already fetched"""
+        obs = self.obs
+        if obs is None:
+            obs = self.fetch_flash_obs(self.obs_time, self.time_window)
+        elif isinstance(obs, Future):
+            # Query errors are raised here, so a failed query falls back to MNWC like no observations
+            obs = obs.result()
+        if len(obs) == 0:
+            raise ValueError("No any observations")
         points = gridpp.Points(obs["latitude"].to_numpy(),
                                obs["longitude"].to_numpy(),
                                obs["elevation"].to_numpy(),)
         return points, obs
 
-    def read_flash_obs(self):
-        analysis_time = dt.strptime(self.obs_time, '%Y%m%d%H%M')
-        timestr = analysis_time.strftime("%Y-%m-%dT%H:%M:%S")
-        start_time = analysis_time - pd.DateOffset(minutes=self.time_window)
-        older_obs = start_time - pd.DateOffset(minutes=self.time_window)
-        end_tstr = timestr
-        start_tstr = start_time.strftime("%Y-%m-%dT%H:%M:%S")
-        older_tstr = older_obs.strftime("%Y-%m-%dT%H:%M:%S")
-        url = "http://smartmet.fmi.fi/timeseries?producer={}&tz=gmt&starttime={}&endtime={}&param=flash_id,longitude,latitude,utctime,altitude,peak_current&format=json".format(
-            "flash", start_tstr, end_tstr)
-        resp = requests.get(url)
-        trad_obs = resp.json()
-        obs = pd.DataFrame(trad_obs)
-        obs.rename(columns={"flash_id": "station_id",
-                            "peak_current": "flash",
-                            "altitude": "elevation"}, inplace=True)
-        if len(obs) == 0:
-            obs = obs.assign(latitude=np.nan)
-            obs = obs.assign(longitude=np.nan)
-        obs = obs.assign(flash=100.0)
-        obs = obs.assign(elevation=0.0)
-
-        url_old = "http://smartmet.fmi.fi/timeseries?producer={}&tz=gmt&starttime={}&endtime={}&param=flash_id,longitude,latitude,utctime,altitude,peak_current&format=json".format(
-            "flash", older_tstr, start_tstr)
-        resp_old = requests.get(url_old)
-        trad_obs_old = resp_old.json()
-        obs_old = pd.DataFrame(trad_obs_old)
-        obs_old.rename(columns={"flash_id": "station_id",
-                            "peak_current": "flash",
-                            "altitude": "elevation"}, inplace=True)
-        if len(obs_old) == 0:
-            obs_old = obs_old.assign(latitude=np.nan)
-            obs_old = obs_old.assign(longitude=np.nan)
-        obs_old = obs_old.assign(flash=40.0)
-        obs_old = obs_old.assign(elevation=0.0)
-        result = pd.concat([obs, obs_old])
-
-        count = len(trad_obs)
-        count_old = len(trad_obs_old)
-        if count_old == 0:
-            print("No older observations from select time")
-            if count == 0:
-                print("No near real time observations")
-                raise ValueError("No any observations")
-        return result
+    @staticmethod
+    def fetch_flash_obs(obs_time, time_window):
+        """Query flash observations of two time windows before obs_time"""
+        return FLASH_CLIENT.read(obs_time, time_window)
 
     def interpolate(self, grid, background, param):
         """Perform optimal interpolation"""
         # Interpolate background data to observation points
         pobs = gridpp.nearest(grid, self.points, background)
-        structure = gridpp.BarnesStructure(20500, 200)
+        if self.context is not None:
+            structure = self.context.structure
+        else:
+            structure = gridpp.BarnesStructure(20500, 200)
         max_points = 20
         obs_to_background_variance_ratio = np.full(self.points.size(), 0.1)
-        print("Performing optimal interpolation")
-        output = gridpp.optimal_interpolation(grid, background, self.points,
-                                              self.obs[param].to_numpy(),
-                                              obs_to_background_variance_ratio,
-                                              pobs, structure, max_points,)
+        with span("optimal_interpolation", points=self.points.size()) as record:
+            output = gridpp.optimal_interpolation(grid, background, self.points,
+                                                  self.obs[param].to_numpy(),
+                                                  obs_to_background_variance_ratio,
+                                                  pobs, structure, max_points,)
+            describe_array(record, output)
         output[output > 100] = 100
         output[output < 10] = 0
         return output
@@ -0,0 +1,108 @@
+import os
+import glob
+import uuid
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime as dt
+from datetime import timedelta as td
+from flash_obs import FlashObservationClient, epoch, from_epoch
+
+COLUMNS = {"flash_id": np.int64,
+           "longitude": np.float64,
+           "latitude": np.float64,
+           "utctime": np.int64,
+           "altitude": np.float32,
+           "peak_current": np.float32}
+
+
+class FlashArchive:
+    """Local append-only archive of flash observations
+
+    Flashes are stored as columnar .npz parts in hourly partitions (root/YYYYMMDDHH/),
+    each part sorted by time. Appending writes a new part and records the covered
+    time range to the time index, so queried windows can be told apart from windows
+    that simply had no flashes.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.index_file = os.path.join(root, "index.txt")
+        os.makedirs(root, exist_ok=True)
+
+    def append(self, flashes: pd.DataFrame, start_time: dt, end_time: dt):
+        """Add flashes observed between start_time and end_time to the archive"""
+        partition_keys = flashes["utctime"].to_numpy() // 3600
+        for key in np.unique(partition_keys):
+            part = flashes[partition_keys == key].sort_values("utctime")
+            partition = self.partition_dir(from_epoch(int(key) * 3600))
+            os.makedirs(partition, exist_ok=True)
+            # Writers sharing the archive (e.g. backfill workers) must never pick the same part name
+            name = f"part-{epoch(start_time)}-{epoch(end_time)}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            path = os.path.join(partition, name + ".npz")
+            tmp_path = os.path.join(partition, name + ".tmp")
+            with open(tmp_path, "wb") as fp:
+                np.savez(fp, **{c: part[c].to_numpy(dtype=t) for c, t in COLUMNS.items()})
+            os.replace(tmp_path, path)
+        with open(self.index_file, "a") as fp:
+            fp.write(f"{epoch(start_time)} {epoch(end_time)}\n")
+
+    def query(self, start_time: dt, end_time: dt) -> pd.DataFrame:
+        """Flashes of [start_time, end_time) window"""
+        start, end = epoch(start_time), epoch(end_time)
+        columns = {c: [] for c in COLUMNS}
+        hour = start_time.replace(minute=0, second=0, microsecond=0)
+        while hour < end_time:
+            for path in sorted(glob.glob(os.path.join(self.partition_dir(hour), "part-*.npz"))):
+                with np.load(path) as part:
+                    first, last = np.searchsorted(part["utctime"], [start, end])
+                    for c in COLUMNS:
+                        columns[c].append(part[c][first:last])
+            hour += td(hours=1)
+        flashes = pd.DataFrame({c: np.concatenate(v) if len(v) > 0 else np.array([], dtype=COLUMNS[c])
+                                for c, v in columns.items()})
+        return flashes.drop_duplicates(subset="flash_id").reset_index(drop=True)
+
+    def covers(self, start_time: dt, end_time: dt) -> bool:
+        """True if whole [start_time, end_time) window has been appended"""
+        if not os.path.isfile(self.index_file):
+            return False
+        ranges = sorted(tuple(int(x) for x in line.split()) for line in open(self.index_file) if line.strip())
+        covered_until = epoch(start_time)
+        for range_start, range_end in ranges:
+            if range_start <= covered_until:
+                covered_until = max(covered_until, range_end)
+        return covered_until >= epoch(end_time)
+
+    def partition_dir(self, time: dt) -> str:
+        return os.path.join(self.root, time.strftime("%Y%m%d%H"))
+
+
+def main():
+    """Fill archive from smartmet server for later offline runs"""
+    args = parse_command_line()
+    archive = FlashArchive(args.archive)
+    client = FlashObservationClient()
+    start_time = dt.strptime(args.start_time, "%Y%m%d%H%M")
+    end_time = dt.strptime(args.end_time, "%Y%m%d%H%M")
+    while start_time < end_time:
+        chunk_end = min(start_time + td(hours=1), end_time)
+        if not archive.covers(start_time, chunk_end):
+            flashes = client.fetch(start_time, chunk_end)
+            # Fetched end time is inclusive, the archive ranges are not
+            flashes = flashes[flashes["utctime"] < epoch(chunk_end)]
+            archive.append(flashes, start_time, chunk_end)
+            print(f"Archived {len(flashes)} flashes {start_time} - {chunk_end}")
+        start_time = chunk_end
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(argument_default=None)
+    parser.add_argument("--archive", action="store", type=str, required=True)
+    parser.add_argument("--start_time", action="store", type=str, required=True)
+    parser.add_argument("--end_time", action="store", type=str, required=True)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    main()
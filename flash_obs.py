@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import requests
+from datetime import datetime as dt
+from datetime import timedelta as td
+from datetime import timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from telemetry import span
+
+SMARTMET_URL = "http://smartmet.fmi.fi/timeseries"
+FLASH_PARAMS = ["flash_id", "longitude", "latitude", "utctime", "altitude", "peak_current"]
+
+
+class FlashObservationClient:
+    """Lightning observations from smartmet server
+
+    Uses one pooled HTTP session with timeout and retries. Both time windows of an
+    analysis are fetched with a single request and flashes are kept in time buckets,
+    so a following cycle only queries the minutes not seen before.
+    With a FlashArchive fetched flashes are also archived and already archived
+    windows are read from it. Offline client reads everything from the archive.
+    """
+    def __init__(self, url: str = SMARTMET_URL,
+                 bucket_minutes: int = 10,
+                 timeout: float = 30,
+                 retries: int = 3,
+                 archive=None,
+                 offline: bool = False):
+        self.url = url
+        self.archive = archive
+        self.offline = offline
+        self.bucket = td(minutes=bucket_minutes)
+        self.timeout = timeout
+        self.buckets = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(total=retries, backoff_factor=1,
+                                                status_forcelist=(500, 502, 503, 504)))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def read(self, obs_time: str, time_window: int) -> pd.DataFrame:
+        """Flashes of two time windows before obs_time in the format used by the analysis
+
+        Flashes of the latest window get value 100 and older ones 40.
+        """
+        end_time = dt.strptime(obs_time, "%Y%m%d%H%M")
+        start_time = end_time - td(minutes=time_window)
+        older_time = start_time - td(minutes=time_window)
+        flashes = self.query(older_time, end_time)
+        recent = flashes["utctime"] >= epoch(start_time)
+        obs = flashes.rename(columns={"flash_id": "station_id",
+                                      "peak_current": "flash",
+                                      "altitude": "elevation"})
+        obs = obs.assign(flash=np.where(recent, 100.0, 40.0))
+        obs = obs.assign(elevation=0.0)
+        if recent.sum() == 0:
+            print("No near real time observations")
+            if len(obs) == 0:
+                print("No observations at all from select times")
+        return obs
+
+    def query(self, start_time: dt, end_time: dt) -> pd.DataFrame:
+        """Flashes between start_time and end_time, both inclusive"""
+        first = self.bucket_start(start_time)
+        bucket_starts = []
+        b = first
+        while b <= end_time:
+            bucket_starts.append(b)
+            b += self.bucket
+        if self.archive is not None:
+            for b in bucket_starts:
+                if b not in self.buckets and self.archive.covers(b, b + self.bucket):
+                    self.buckets[b] = self.archive.query(b, b + self.bucket)
+        missing = [b for b in bucket_starts if b not in self.buckets]
+        parts = [self.buckets[b] for b in bucket_starts if b in self.buckets]
+        if len(missing) > 0:
+            fetch_start = max(missing[0], start_time)
+            if self.offline:
+                parts.append(self.archive.query(fetch_start, end_time + td(seconds=1)))
+            else:
+                fetched = self.fetch(fetch_start, end_time)
+                parts.append(fetched)
+                self.store(fetched, fetch_start, end_time)
+                if self.archive is not None:
+                    self.archive.append(fetched[fetched["utctime"] < epoch(end_time)], fetch_start, end_time)
+        # Buckets older than this query are not needed anymore
+        for b in [b for b in self.buckets if b < first]:
+            del self.buckets[b]
+        flashes = pd.concat(parts, ignore_index=True)
+        flashes = flashes[(flashes["utctime"] >= epoch(start_time)) & (flashes["utctime"] <= epoch(end_time))]
+        return flashes.drop_duplicates(subset="flash_id").reset_index(drop=True)
+
+    def fetch(self, start_time: dt, end_time: dt) -> pd.DataFrame:
+        params = {"producer": "flash",
+                  "tz": "gmt",
+                  "starttime": start_time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "endtime": end_time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "param": ",".join(FLASH_PARAMS),
+                  "timeformat": "epoch",
+                  "format": "json"}
+        with span("observation_fetch", start=params["starttime"], end=params["endtime"]) as record:
+            resp = self.session.get(self.url, params=params, timeout=self.timeout)
+            resp.raise_for_status()
+            flashes = pd.DataFrame(resp.json(), columns=FLASH_PARAMS)
+            flashes["utctime"] = flashes["utctime"].astype(np.int64)
+            record["bytes"] = len(resp.content)
+            record["flashes"] = len(flashes)
+        return flashes
+
+    def store(self, flashes: pd.DataFrame, fetch_start: dt, fetch_end: dt):
+        """Keep flashes of buckets fully covered by the fetched time range"""
+        bucket_seconds = int(self.bucket.total_seconds())
+        keys = flashes["utctime"] - flashes["utctime"] % bucket_seconds
+        b = self.bucket_start(fetch_start)
+        if b < fetch_start:
+            b += self.bucket
+        while b + self.bucket <= fetch_end:
+            self.buckets[b] = flashes[keys == epoch(b)]
+            b += self.bucket
+
+    def bucket_start(self, time: dt) -> dt:
+        bucket_seconds = int(self.bucket.total_seconds())
+        return from_epoch(epoch(time) - epoch(time) % bucket_seconds)
+
+
+def epoch(time: dt) -> int:
+    return int(time.replace(tzinfo=timezone.utc).timestamp())
+
+
+def from_epoch(seconds: int) -> dt:
+    return dt.fromtimestamp(seconds, tz=timezone.utc).replace(tzinfo=None)
+
+
+# Shared by all readers of the process, so the session and the buckets stay warm
+FLASH_CLIENT = FlashObservationClient()
@@ -0,0 +1,97 @@
+import os
+import numpy as np
+from dataclasses import dataclass
+from datetime import datetime as dt
+from file_utils import ReadData
+
+
+@dataclass
+class Frame:
+    """Single 0h rprate field in the same shape ReadData would give it"""
+    data: np.array
+    dtime: list
+
+    @property
+    def mask_nodata(self):
+        return np.ma.masked_where(self.data == 9999, self.data)
+
+
+class FrameStore:
+    """Rolling store of rprate 0h frames keyed by valid time
+
+    Consecutive cycles share three of their four rprate frames, so only the newest
+    file needs to be decoded when the store is kept between cycles. With cache_dir
+    frames are also saved as .npy files and memory-mapped back in, so the store
+    survives over separate processes.
+    """
+    def __init__(self, max_frames: int = 4, cache_dir: str = None, dtype=None):
+        self.max_frames = max_frames
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        self.frames = {}
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def read(self, data_file: str) -> Frame:
+        """Return 0h frame of data_file, decoding the file only if frame is not stored"""
+        valid_time = self.valid_time_from_filename(data_file)
+        if valid_time is not None:
+            frame = self.get(valid_time)
+            if frame is not None:
+                print(f"Using stored frame {valid_time:%Y%m%d%H%M} for {data_file}")
+                return frame
+        data = ReadData(data_file, dtype=self.dtype)
+        frame = Frame(data.data[:1], data.dtime[:1])
+        if valid_time is not None and valid_time == frame.dtime[0]:
+            self.put(frame)
+        return frame
+
+    def get(self, valid_time: dt):
+        if valid_time in self.frames:
+            return self.frames[valid_time]
+        if self.cache_dir is not None and os.path.isfile(self.frame_path(valid_time)):
+            try:
+                frame = Frame(np.load(self.frame_path(valid_time), mmap_mode="r"), [valid_time])
+            except ValueError:
+                # Unreadable frame is decoded from its file again
+                print(f"Removing unreadable stored frame {valid_time:%Y%m%d%H%M}")
+                os.remove(self.frame_path(valid_time))
+                return None
+            self.frames[valid_time] = frame
+            return frame
+        return None
+
+    def put(self, frame: Frame):
+        valid_time = frame.dtime[0]
+        self.frames[valid_time] = frame
+        if self.cache_dir is not None:
+            # Write to a temporary file first so an interrupted write never leaves a partial frame
+            path = self.frame_path(valid_time)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "wb") as fp:
+                    np.save(fp, np.asarray(frame.data))
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """Keep only max_frames newest frames in memory and on disk"""
+        for valid_time in sorted(self.frames)[:-self.max_frames]:
+            del self.frames[valid_time]
+        if self.cache_dir is not None:
+            stored = sorted(f for f in os.listdir(self.cache_dir) if f.startswith("rprate_") and f.endswith(".npy"))
+            for f in stored[:-self.max_frames]:
+                os.remove(os.path.join(self.cache_dir, f))
+
+    def frame_path(self, valid_time: dt) -> str:
+        return os.path.join(self.cache_dir, f"rprate_{valid_time:%Y%m%d%H%M}.npy")
+
+    @staticmethod
+    def valid_time_from_filename(data_file: str):
+        try:
+            return dt.strptime(os.path.split(data_file)[-1].split("-")[0], "%Y%m%d%H%M")
+        except ValueError:
+            return None
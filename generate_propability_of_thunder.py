@@ -1,9 +1,31 @@
+import os
 import sys
+import time
 import argparse
+import traceback
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from datetime import timedelta as td
+from eccodes import codes_clone
 import tools as tl
-from file_utils import ReadData, WriteData
-from nwc_extrapolation import ExtrapolatedNWC
+import api
+from file_utils import ReadData, WriteData, DATASET_CACHE
+from grib_index import GRIB_INDEXES
+from nwc_extrapolation import ExtrapolatedNWC, EnsembleNWC
 from flash_analysis import Analysis
+from frame_store import FrameStore
+import tiling
+from motion_state import MotionState
+from telemetry import TRACER
+from flash_obs import FLASH_CLIENT
+from flash_archive import FlashArchive
+from s3_upload import wait_for_uploads
+
+# Kept between cycles in resident mode
+FRAME_STORE = None
+FETCH_EXECUTOR = None
+MOTION_STATE = None
 
 
 def main():
@@ -23,30 +45,132 @@ def main():
 
     """
     args = parse_command_line()
+    if args.resident:
+        run_resident(args)
+    else:
+        try:
+            run_cycle(args)
+        finally:
+            # Output is uploaded in the background, the process must not exit before it is done
+            failed_uploads = wait_for_uploads()
+        if len(failed_uploads) > 0:
+            sys.exit(1)
+
+
+def run_resident(args):
+    """Keep the process alive and run one nowcast cycle at every 15 min boundary
+
+    Imported libraries and everything cached on module level (e.g. grid coordinates)
+    stay warm between the cycles. Analysis time of each cycle is the boundary
+    minus args.resident_delay minutes, input files are generated from args.data_root.
+    """
+    while True:
+        wake_time = tl.next_cycle_time(dt.utcnow())
+        time.sleep(max((wake_time - dt.utcnow()).total_seconds(), 0))
+        start_time = (wake_time - td(minutes=args.resident_delay)).strftime("%Y%m%d%H%M")
+        # Uploads of the previous cycle have had a whole cycle to finish, this reports their failures
+        wait_for_uploads()
+        # A failed cycle must not stop the service, next slot is tried anyway
+        run_cycle_safely(cycle_arguments(args, start_time))
+
+
+def cycle_arguments(args, start_time):
+    """Copy of args with input files generated from args.data_root for start_time"""
+    rprate_files, mnwc_tstm_file = tl.generate_cycle_file_paths(start_time, args.data_root)
+    cycle_args = argparse.Namespace(**vars(args))
+    cycle_args.start_time = start_time
+    cycle_args.rprate_0_file, cycle_args.rprate_1_file, \
+        cycle_args.rprate_2_file, cycle_args.rprate_3_file = rprate_files
+    cycle_args.mnwc_tstm_file = mnwc_tstm_file
+    cycle_args.output = args.output.format(start_time=start_time)
+    if args.chunked_output is not None:
+        cycle_args.chunked_output = args.chunked_output.format(start_time=start_time)
+    return cycle_args
+
+
+def run_cycle_safely(args) -> bool:
+    """Run one cycle, print the error instead of raising it. Returns True on success"""
+    print(f"Starting cycle {args.start_time}")
+    start = time.time()
+    success = True
+    try:
+        run_cycle(args)
+    except (Exception, SystemExit):
+        traceback.print_exc()
+        print(f"Cycle {args.start_time} failed")
+        success = False
+    print("Cycle {} done in {:.2f} seconds".format(args.start_time, time.time() - start))
+    return success
+
+
+def run_cycle(args):
+    """Run one nowcast cycle from input files to output file, tracing its stages"""
+    TRACER.start_cycle(args.start_time)
+    status = "failed"
+    try:
+        run_pipeline(args)
+        status = "ok"
+    finally:
+        TRACER.end_cycle(args.telemetry_file, status)
+        if args.prometheus_file is not None:
+            TRACER.write_prometheus(args.prometheus_file)
+
+
+def run_pipeline(args):
+    global FRAME_STORE, FETCH_EXECUTOR, MOTION_STATE
+    # In low memory mode fields are decoded to float32 and masks are never built
+    dtype = np.float32 if args.low_memory else None
+
+    def report_memory(stage):
+        if args.low_memory or args.memory_budget_mb is not None:
+            tl.report_peak_memory(stage, args.memory_budget_mb)
+
+    if args.low_memory or args.memory_budget_mb is not None:
+        # Peak of the first stage must not include earlier cycles
+        tl.reset_peak_memory()
+
+    if FRAME_STORE is None:
+        FRAME_STORE = FrameStore(cache_dir=args.frame_cache_dir, dtype=dtype)
+    if MOTION_STATE is None and args.warm_motion:
+        MOTION_STATE = MotionState(args.motion_state_file, args.motion_blend, args.motion_reuse_threshold)
+    if FETCH_EXECUTOR is None:
+        FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=args.fetch_workers)
+    if args.flash_archive is not None and FLASH_CLIENT.archive is None:
+        FLASH_CLIENT.archive = FlashArchive(args.flash_archive)
+        FLASH_CLIENT.offline = args.offline
     # Make sure order if from oldest to newest, check any wrong files
     initial_files = tl.validate_and_sort_filenames([args.rprate_3_file, args.rprate_2_file,
                                                     args.rprate_1_file, args.rprate_0_file])
+    # Start the MNWC download and the flash query at once, readers below wait for their own input
+    tl.S3_PREFETCHED.clear()
+    tl.S3_READER.new_cycle()
+    # Files of the previous cycle are not read again, rprate frames are kept by FRAME_STORE
+    DATASET_CACHE.clear()
+    GRIB_INDEXES.clear()
+    flash_obs = FETCH_EXECUTOR.submit(Analysis.fetch_flash_obs, args.start_time, args.obs_time_window)
+    # Rprate frames are decoded while their files are streamed, see Dataset.stream, and the MNWC
+    # file is downloaded only if it has no index for range reads
+    tl.prefetch_s3_files([args.mnwc_tstm_file], FETCH_EXECUTOR)
     try:
         # create POT_0h analysis grid from observation.
         # If no observations, use model data only. If no model data, everything will break
-        pot_data = Analysis(args.mnwc_tstm_file, args.start_time, args.obs_time_window)
+        pot_data = Analysis(args.mnwc_tstm_file, args.start_time, args.obs_time_window,
+                            obs=flash_obs, dtype=dtype)
+        report_memory("analysis")
 
         # Read data for generating a wind field
+        analysis_info = None
+        frames = []
         if len(initial_files) == 4:
-            for i, data_file in enumerate(initial_files):
+            for data_file in initial_files:
                 try:
-                    data = ReadData(data_file)
-                    if i == 0:
-                        analysis_info = tl.create_dict(data)
-                    elif i > 0:
-                        analysis_info = tl.add_to_dict(analysis_info, data)
-
+                    frames.append(FRAME_STORE.read(data_file))
                 except FileNotFoundError as f:
                     print("Some of rprate-files are missing, use latest file if exist")
                     # Generate path to a latest full precipitation rate file
                     rp_file = tl.generate_backup_data_path(initial_files[-1])
                     try:
-                        data = ReadData(rp_file, time_steps=3)
+                        data = ReadData(rp_file, time_steps=3, dtype=dtype)
                         analysis_info = {"data": data.data, "mask": data.mask_nodata, "time": data.dtime}
                         break
                     except FileNotFoundError as ff:
@@ -56,40 +180,173 @@ def main():
             print("Some of rprate-files are wrong or missing, use latest rp-file if exist")
             rp_file = tl.generate_backup_data_path(initial_files[-1])
             try:
-                data = ReadData(rp_file, time_steps=3)
+                data = ReadData(rp_file, time_steps=3, dtype=dtype)
                 analysis_info = {"data": data.data, "mask": data.mask_nodata, "time": data.dtime}
             except FileNotFoundError as ff:
                 print(f"{rp_file} not found")
                 raise FileNotFoundError(f"No precipitation intensity file {rp_file} found!")
+        report_memory("reading rprate")
 
         print("Calculate a motion vector field")
-        nwc_data = tl.generate_nowcast_array(analysis_info)
-        exrtapolated_fcst = ExtrapolatedNWC(nwc_data.data,  nwc_data.mask,
-                                            pot_data=pot_data.output)
-        exrtapolated_fcst = tl.convert_nan_to_zeros(exrtapolated_fcst)
-        WriteData(exrtapolated_fcst, pot_data.template, args.output,
-                  's3' if args.output.startswith('s3://') else 'local')
+        if analysis_info is None and args.low_memory:
+            nwc_data = tl.stack_frames(frames)
+        else:
+            if analysis_info is None:
+                analysis_info = tl.create_dict(frames[0])
+                for data in frames[1:]:
+                    analysis_info = tl.add_to_dict(analysis_info, data)
+            nwc_data = tl.generate_nowcast_array(analysis_info)
+        if args.ensemble_members > 0:
+            write_ensemble(args, nwc_data, pot_data)
+            report_memory("ensemble")
+            return
+        tiles = tiling.parse_tiles(args.tiles) if args.tiles else None
+        if args.stream:
+            # Each lead time is extrapolated, cleaned and written before the next one is computed
+            exrtapolated_fcst = ExtrapolatedNWC(nwc_data.data,  nwc_data.mask,
+                                                pot_data=pot_data.output, stream=True, tiles=tiles,
+                                                tile_workers=args.tile_workers, motion_factor=args.motion_factor,
+                                                motion_state=MOTION_STATE, valid_times=nwc_data.time)
+            WriteData(exrtapolated_fcst.leadtimes(), pot_data.template, args.output,
+                      's3' if args.output.startswith('s3://') else 'local', **write_options(args))
+        else:
+            exrtapolated_fcst = api.extrapolate(nwc_data.data, pot_data.output,
+                                                dt.strptime(args.start_time, "%Y%m%d%H%M"),
+                                                rprate_mask=nwc_data.mask, rprate_times=nwc_data.time,
+                                                tiles=tiles, tile_workers=args.tile_workers,
+                                                motion_factor=args.motion_factor, motion_state=MOTION_STATE)
+            report_memory("extrapolation")
+            WriteData(exrtapolated_fcst, pot_data.template, args.output,
+                      's3' if args.output.startswith('s3://') else 'local', **write_options(args))
+        report_memory("writing")
     except KeyError as e:
         # if not model file, this will crash
-        MNWC_fcst = ReadData(args.mnwc_tstm_file, use_as_template=True, time_steps=16)
+        MNWC_fcst = ReadData(args.mnwc_tstm_file, use_as_template=True, time_steps=16, dtype=dtype)
         WriteData(MNWC_fcst, MNWC_fcst.template, args.output,
-                  's3' if args.output.startswith('s3://') else 'local')
+                  's3' if args.output.startswith('s3://') else 'local', **write_options(args))
+        report_memory("writing")
+
+
+def write_ensemble(args, nwc_data, pot_data):
+    """Probability of POT exceeding threshold to output, requested percentiles to output_p<N>"""
+    ensemble = EnsembleNWC(nwc_data.data, nwc_data.mask, pot_data.output, n_members=args.ensemble_members,
+                           workers=args.ensemble_workers, threshold=args.ensemble_threshold,
+                           percentiles=args.ensemble_percentiles, motion_factor=args.motion_factor)
+    write_option = 's3' if args.output.startswith('s3://') else 'local'
+    # WriteData releases its template, so every percentile output gets a clone
+    for p, field in ensemble.percentiles.items():
+        root, ext = os.path.splitext(args.output)
+        output = f"{root}_p{p:g}{ext}"
+        WriteData(field, codes_clone(pot_data.template), output, write_option,
+                  **dict(write_options(args), chunked_output=None))
+    WriteData(ensemble, pot_data.template, args.output, write_option, **write_options(args))
+
+
+def write_options(args) -> dict:
+    """Keyword arguments of WriteData from command line arguments"""
+    return {"encode_workers": args.encode_workers, "encode_executor": args.encode_executor,
+            "packing": args.packing, "bits_per_value": args.bits_per_value,
+            "chunked_output": args.chunked_output}
 
 
 def parse_command_line():
+    parser = build_parser()
+    args = parser.parse_args()
+    check_arguments(parser, args)
+    if args.resident:
+        # Every cycle must write its own output
+        if "{start_time}" not in args.output:
+            parser.error("--output must contain '{start_time}' with --resident")
+        if args.chunked_output is not None and "{start_time}" not in args.chunked_output:
+            parser.error("--chunked_output must contain '{start_time}' with --resident")
+    else:
+        cycle_args = ["start_time", "rprate_0_file", "rprate_1_file", "rprate_2_file",
+                      "rprate_3_file", "mnwc_tstm_file"]
+        missing = [f"--{a}" for a in cycle_args if getattr(args, a) is None]
+        if len(missing) > 0:
+            parser.error(f"the following arguments are required: {', '.join(missing)}")
+    return args
+
+
+def check_arguments(parser, args):
+    """Checks of argument combinations shared with backfill.py"""
+    if args.offline and args.flash_archive is None:
+        parser.error("--offline requires --flash_archive")
+    if args.stream and args.tiles is not None:
+        parser.error("--stream cannot be used with --tiles, it extrapolates the whole domain")
+
+
+def build_parser():
     parser = argparse.ArgumentParser(argument_default=None)
-    parser.add_argument("--start_time", action="store", type=str, required=True)
+    parser.add_argument("--start_time", action="store", type=str, required=False)
     parser.add_argument("--wind_field_param", action="store", type=str, required=True)
     parser.add_argument("--obs_time_window", action="store", type=int, required=True)
-    parser.add_argument("--output", action="store", type=str, required=True)
+    parser.add_argument("--output", action="store", type=str, required=True,
+                        help="Output file, in resident and backfill mode may contain '{start_time}'")
     parser.add_argument("--file_source", action="store", type=str, required=True)
-    parser.add_argument("--rprate_0_file", action="store", type=str, required=True)
-    parser.add_argument("--rprate_1_file", action="store", type=str, required=True)
-    parser.add_argument("--rprate_2_file", action="store", type=str, required=True)
-    parser.add_argument("--rprate_3_file", action="store", type=str, required=True)
-    parser.add_argument("--mnwc_tstm_file", action="store", type=str, required=True)
-    args = parser.parse_args()
-    return args
+    parser.add_argument("--rprate_0_file", action="store", type=str, required=False)
+    parser.add_argument("--rprate_1_file", action="store", type=str, required=False)
+    parser.add_argument("--rprate_2_file", action="store", type=str, required=False)
+    parser.add_argument("--rprate_3_file", action="store", type=str, required=False)
+    parser.add_argument("--mnwc_tstm_file", action="store", type=str, required=False)
+    parser.add_argument("--resident", action="store_true", default=False,
+                        help="Run as a service, one cycle at every 15 min boundary")
+    parser.add_argument("--data_root", action="store", type=str, default="s3://hrnwc/preop",
+                        help="Root of input files in resident and backfill mode")
+    parser.add_argument("--resident_delay", action="store", type=int, default=30,
+                        help="Minutes between wall clock and analysis time in resident mode")
+    parser.add_argument("--frame_cache_dir", action="store", type=str, default=None,
+                        help="Local directory for keeping decoded rprate frames between runs")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="Extrapolate and write one lead time at a time")
+    parser.add_argument("--encode_workers", action="store", type=int, default=1,
+                        help="Number of workers encoding grib messages in parallel")
+    parser.add_argument("--encode_executor", action="store", type=str, default="process",
+                        choices=["thread", "process"],
+                        help="Use 'thread' only with an eccodes build known to be thread safe")
+    parser.add_argument("--fetch_workers", action="store", type=int, default=6,
+                        help="Number of concurrent input downloads and queries")
+    parser.add_argument("--flash_archive", action="store", type=str, default=None,
+                        help="Local flash archive directory, see flash_archive.py")
+    parser.add_argument("--offline", action="store_true", default=False,
+                        help="Read flashes only from --flash_archive")
+    parser.add_argument("--low_memory", action="store_true", default=False,
+                        help="Decode fields to float32 buffers and skip building masked arrays")
+    parser.add_argument("--memory_budget_mb", action="store", type=float, default=None,
+                        help="Report peak memory per stage and warn when it exceeds this")
+    parser.add_argument("--tiles", action="store", type=str, default=None,
+                        help="Compute motion and extrapolation in overlapping tiles, e.g. 2x2")
+    parser.add_argument("--tile_workers", action="store", type=int, default=1,
+                        help="Number of processes for tiled computation")
+    parser.add_argument("--motion_factor", action="store", type=int, default=1,
+                        help="Estimate motion field on this many times coarser grid, see compare_motion.py")
+    parser.add_argument("--warm_motion", action="store_true", default=False,
+                        help="Reuse or blend with the motion field of the previous cycle")
+    parser.add_argument("--motion_state_file", action="store", type=str, default=None,
+                        help="File for keeping the previous motion field between runs")
+    parser.add_argument("--motion_blend", action="store", type=float, default=0.3,
+                        help="Weight of the previous motion field when blending")
+    parser.add_argument("--motion_reuse_threshold", action="store", type=float, default=0.2,
+                        help="Reuse previous motion field if relative change is below this")
+    parser.add_argument("--packing", action="store", type=str, default="simple", choices=["simple", "ccsds", "jpeg"],
+                        help="Packing of output grib messages")
+    parser.add_argument("--bits_per_value", action="store", type=int, default=24,
+                        help="Bits per value of output grib messages")
+    parser.add_argument("--chunked_output", action="store", type=str, default=None,
+                        help="Also write output as NetCDF4 (.nc) or Zarr (.zarr), one lead time per chunk")
+    parser.add_argument("--ensemble_members", action="store", type=int, default=0,
+                        help="Number of LINDA ensemble members, 0 for the deterministic nowcast")
+    parser.add_argument("--ensemble_workers", action="store", type=int, default=1,
+                        help="Number of processes computing ensemble members")
+    parser.add_argument("--ensemble_threshold", action="store", type=float, default=10,
+                        help="POT threshold (%%) of the exceedance probability written to output")
+    parser.add_argument("--ensemble_percentiles", action="store", type=float, nargs="*", default=[],
+                        help="Percentiles of ensemble POT written to output_p<N>.grib2")
+    parser.add_argument("--telemetry_file", action="store", type=str, default=None,
+                        help="Append JSON record of stage timings per cycle to this file instead of stdout")
+    parser.add_argument("--prometheus_file", action="store", type=str, default=None,
+                        help="Write stage counters in Prometheus text format to this file")
+    return parser
 
 
 if __name__ == '__main__':
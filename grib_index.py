@@ -0,0 +1,86 @@
+import os
+import sys
+import json
+import datetime
+from eccodes import (codes_grib_new_from_file, codes_get_long, codes_get_string,
+                     codes_get_message_offset, codes_release)
+
+# Indexes of already scanned local files, keyed by path, cleared at the start of every cycle
+GRIB_INDEXES = {}
+
+
+def read_leadtime(gh):
+    tr = codes_get_long(gh, "indicatorOfUnitOfTimeRange")
+    ft = codes_get_long(gh, "forecastTime")
+    if tr == 1:
+        return datetime.timedelta(hours=ft)
+    if tr == 0:
+        return datetime.timedelta(minutes=ft)
+    raise Exception("Unknown indicatorOfUnitOfTimeRange: {:%d}".format(tr))
+
+
+class GribIndex:
+    """Byte offsets, lead times and parameter keys of messages in a grib file
+
+    Built by scanning message headers only, so selected messages can be decoded
+    without decoding the ones before them. Saved next to the data file as
+    <file>.idx, which also allows byte range reads of single messages from S3.
+    """
+    def __init__(self, entries: list):
+        self.entries = entries
+
+    @classmethod
+    def build(cls, data_file: str):
+        entries = []
+        with open(data_file, "rb") as fp:
+            while True:
+                gh = codes_grib_new_from_file(fp, headers_only=True)
+                if gh is None:
+                    break
+                entries.append({"offset": codes_get_message_offset(gh),
+                                "length": codes_get_long(gh, "totalLength"),
+                                "leadtime": int(read_leadtime(gh).total_seconds() / 60),
+                                "shortName": codes_get_string(gh, "shortName"),
+                                "paramId": codes_get_long(gh, "paramId"),
+                                "level": codes_get_long(gh, "level")})
+                codes_release(gh)
+        return cls(entries)
+
+    @classmethod
+    def for_file(cls, data_file: str):
+        """Index of a local file from memory, sidecar or by scanning the file"""
+        mtime = os.path.getmtime(data_file)
+        if data_file in GRIB_INDEXES and GRIB_INDEXES[data_file][0] == mtime:
+            return GRIB_INDEXES[data_file][1]
+        sidecar = data_file + ".idx"
+        if os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= mtime:
+            with open(sidecar) as fp:
+                index = cls.from_json(fp.read())
+        else:
+            index = cls.build(data_file)
+        GRIB_INDEXES[data_file] = (mtime, index)
+        return index
+
+    def select(self, leadtimes: list = None, params: list = None) -> list:
+        """Entries with lead time (minutes) in leadtimes and shortName in params"""
+        return [e for e in self.entries
+                if (leadtimes is None or e["leadtime"] in leadtimes) and
+                (params is None or e["shortName"] in params)]
+
+    def to_json(self) -> str:
+        return json.dumps(self.entries)
+
+    @classmethod
+    def from_json(cls, text: str):
+        return cls(json.loads(text))
+
+    def save(self, path: str):
+        with open(path, "w") as fp:
+            fp.write(self.to_json())
+
+
+if __name__ == '__main__':
+    # Write sidecar indexes for given local grib files
+    for f in sys.argv[1:]:
+        GribIndex.build(f).save(f + ".idx")
+        print(f"Wrote {f}.idx")
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from eccodes import codes_get_array, codes_get_string
+
+
+class GridCache:
+    """Cache of grid coordinates keyed by hash of grib grid definition section
+
+    Expanding latitudes and longitudes of a large grid is slow and the grid does not
+    change between runs. Coordinates are kept in memory for the lifetime of the process
+    and, if cache_dir is given, also as memory-mapped .npy files on local disk.
+    Disk cache is limited to max_bytes, least recently used grids are removed first.
+    """
+    def __init__(self, cache_dir: str = None, max_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.coordinates = {}
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def grid_hash(gh) -> str:
+        return codes_get_string(gh, "md5Section3")
+
+    def read_coordinates(self, gh, ni, nj, grid_hash=None):
+        """Return read-only latitudes and longitudes of grib message gh"""
+        if grid_hash is None:
+            grid_hash = self.grid_hash(gh)
+        if grid_hash in self.coordinates:
+            return self.coordinates[grid_hash]
+        coordinates = self.load(grid_hash)
+        if coordinates is None:
+            latitudes = np.asarray(codes_get_array(gh, "latitudes").reshape(nj, ni))
+            longitudes = np.asarray(codes_get_array(gh, "longitudes").reshape(nj, ni))
+            self.save(grid_hash, latitudes, longitudes)
+            # Shared between readers, so nobody is allowed to modify these in place
+            latitudes.setflags(write=False)
+            longitudes.setflags(write=False)
+            coordinates = (latitudes, longitudes)
+        self.coordinates[grid_hash] = coordinates
+        return coordinates
+
+    def load(self, grid_hash):
+        if self.cache_dir is None:
+            return None
+        paths = self.paths(grid_hash)
+        if not all(os.path.isfile(p) for p in paths):
+            return None
+        for p in paths:
+            # Modification time is used as last access time for eviction
+            os.utime(p)
+        return tuple(np.load(p, mmap_mode="r") for p in paths)
+
+    def save(self, grid_hash, latitudes, longitudes):
+        if self.cache_dir is None:
+            return
+        for path, values in zip(self.paths(grid_hash), (latitudes, longitudes)):
+            # Write to a temporary file first so parallel processes never see partial files
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as fp:
+                np.save(fp, values)
+            os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used grids until cache fits to max_bytes"""
+        files = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".npy")]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        while total > self.max_bytes and len(files) > 2:
+            f = files.pop(0)
+            total -= os.path.getsize(f)
+            os.remove(f)
+
+    def paths(self, grid_hash):
+        return (os.path.join(self.cache_dir, f"{grid_hash}_latitudes.npy"),
+                os.path.join(self.cache_dir, f"{grid_hash}_longitudes.npy"))
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from datetime import datetime as dt
+from datetime import timedelta as td
+from pysteps import extrapolation
+
+
+class MotionState:
+    """Motion field of the previous cycle, kept in memory and optionally in a .npz file
+
+    Consecutive cycles share two of the three frames used for Lucas-Kanade and the flow
+    changes slowly. If the previous field still explains the newest frame (relative RMSE
+    of the advected previous frame below reuse_threshold) it is reused as is and motion
+    detection is skipped. Otherwise the new field is blended with the previous one,
+    blend being the weight of the previous field.
+    """
+    def __init__(self, path: str = None,
+                 blend: float = 0.3,
+                 reuse_threshold: float = 0.2,
+                 time_step: td = td(minutes=15)):
+        self.path = path
+        self.blend = blend
+        self.reuse_threshold = reuse_threshold
+        self.time_step = time_step
+        self.V = None
+        self.frame = None
+        self.valid_time = None
+        if self.path is not None and os.path.isfile(self.path):
+            self.load()
+
+    def update(self, data: np.array, valid_time: dt, calculate_wind_field) -> np.array:
+        """Return motion field for frames data, newest of them valid at valid_time
+
+        calculate_wind_field is called only when the previous field cannot be reused.
+        """
+        frame = np.array(data[-1], dtype=np.float32)
+        frame[frame == 9999] = np.nan
+        if self.V is not None and self.valid_time + self.time_step == valid_time:
+            change = self.relative_change(frame)
+            print("Relative change to previous motion field {:.3f}".format(change))
+            if change < self.reuse_threshold:
+                print("Reusing previous motion field")
+                V = self.V
+            else:
+                V = (1.0 - self.blend) * calculate_wind_field() + self.blend * self.V
+        else:
+            V = calculate_wind_field()
+        self.V = V
+        self.frame = frame
+        self.valid_time = valid_time
+        if self.path is not None:
+            self.save()
+        return V
+
+    def relative_change(self, frame: np.array) -> float:
+        """RMSE of previous frame advected one step with previous field, relative to std of frame"""
+        extrapolate = extrapolation.get_method("semilagrangian")
+        advected = extrapolate(self.frame, self.V, 1, allow_nonfinite_values=True)[0]
+        valid = np.isfinite(advected) & np.isfinite(frame)
+        if not np.any(valid):
+            return np.inf
+        std = np.std(frame[valid])
+        if std == 0:
+            return 0.0 if np.allclose(advected[valid], frame[valid]) else np.inf
+        return float(np.sqrt(np.mean((advected[valid] - frame[valid]) ** 2)) / std)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, V=self.V, frame=self.frame, valid_time=self.valid_time.strftime("%Y%m%d%H%M"))
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        with np.load(self.path) as state:
+            self.V = state["V"]
+            self.frame = state["frame"]
+            self.valid_time = dt.strptime(str(state["valid_time"]), "%Y%m%d%H%M")
@@ -1,36 +1,108 @@
+import collections
+import tempfile
 import numpy as np
-from pysteps import nowcasts
+from concurrent.futures import ProcessPoolExecutor
+from pysteps import nowcasts, extrapolation
 from pysteps.nowcasts import linda
 import tools as tl
+import tiling
+from telemetry import span, describe_array
 
 
 class ExtrapolatedNWC:
     def __init__(self, data: np.array,
                  nodata: np.array,
                  n_leadtimes: int = 17,
-                 pot_data=None):
+                 pot_data=None,
+                 stream: bool = False,
+                 tiles: tuple = None,
+                 tile_workers: int = 1,
+                 motion_factor: int = 1,
+                 motion_state=None,
+                 valid_times=None):
         self.data_input = data
+        # Previous motion field to reuse or blend with, valid_times are times of data
+        self.motion_state = motion_state
+        self.valid_times = valid_times
+        # Motion field is estimated on a motion_factor times coarser grid
+        self.motion_factor = motion_factor
+        # With tiles (ny, nx) motion and extrapolation are computed per tile in a process pool
+        self.tiles = tiles
+        self.tile_workers = tile_workers
         self.nodata = nodata
         self.data = None
         self.V = None
         self.n_leadtimes = n_leadtimes
         self.pot = pot_data
-        self.calculate_nwc()
+        # In stream mode nothing is calculated here, fields are generated by leadtimes()
+        if not stream:
+            self.calculate_nwc()
         #self.calculate_nwc_linda()
 
+    def calculate_wind_field(self):
+        with span("motion_estimation") as record:
+            describe_array(record, self.data_input)
+            if self.motion_state is not None:
+                # Motion is estimated from three oldest frames, see tools.calculate_wind_field
+                n_frames = min(3, len(self.data_input))
+                return self.motion_state.update(self.data_input[:n_frames], self.valid_times[n_frames - 1],
+                                                self.estimate_wind_field)
+            return self.estimate_wind_field()
+
+    def estimate_wind_field(self):
+        if self.tiles is not None:
+            return tiling.tiled_wind_field(self.data_input, self.nodata, self.tiles, self.tile_workers,
+                                           factor=self.motion_factor)
+        return tl.calculate_wind_field(self.data_input, self.nodata, self.motion_factor)
+
     def calculate_nwc(self):
         # Estimate the motion field with Lucas-Kanade
-        self.V = tl.calculate_wind_field(self.data_input, self.nodata)
+        self.V = self.calculate_wind_field()
         # Extrapolate the last radar observation
-        extrapolate = nowcasts.get_method("extrapolation")
+        if self.tiles is not None:
+            def extrapolate(field, V, n_leadtimes):
+                return tiling.tiled_extrapolation(field, V, n_leadtimes, self.tiles, self.tile_workers)
+        else:
+            extrapolate = nowcasts.get_method("extrapolation")
+        with span("extrapolation") as record:
+            if self.pot is not None:
+                try:
+                    self.data = extrapolate(self.pot[-1, :, :], self.V, self.n_leadtimes)
+                except:
+                    self.data = extrapolate(self.pot, self.V, self.n_leadtimes)
+                self.data[self.data < 10] = 0.0
+            else:
+                self.data = extrapolate(self.data_input[-1, :, :], self.V, self.n_leadtimes)
+            describe_array(record, self.data)
+
+    def leadtimes(self):
+        """Extrapolate one lead time at a time and yield each field as soon as it is ready
+
+        Yields the same fields as calculate_nwc followed by tools.convert_nan_to_zeros,
+        but keeps only the latest field and the cumulative displacement in memory.
+        Tiles are not supported, the whole domain is extrapolated at each step.
+        """
+        if self.tiles is not None:
+            raise ValueError("Tiled extrapolation is not supported one lead time at a time")
+        self.V = self.calculate_wind_field()
         if self.pot is not None:
-            try:
-                self.data = extrapolate(self.pot[-1, :, :], self.V, self.n_leadtimes)
-            except:
-                self.data = extrapolate(self.pot, self.V, self.n_leadtimes)
-            self.data[self.data < 10] = 0.0
+            field = self.pot[-1, :, :] if self.pot.ndim == 3 else self.pot
         else:
-            self.data = extrapolate(self.data_input[-1, :, :], self.V, self.n_leadtimes)
+            field = self.data_input[-1, :, :]
+        extrapolate = extrapolation.get_method("semilagrangian")
+        allow_nonfinite_values = bool(np.any(~np.isfinite(field)))
+        displacement = None
+        for i in range(self.n_leadtimes):
+            with span("extrapolation", leadtime=i) as record:
+                step, displacement = extrapolate(field, self.V, 1, displacement_prev=displacement,
+                                                 return_displacement=True,
+                                                 allow_nonfinite_values=allow_nonfinite_values)
+                step = step[0]
+                if self.pot is not None:
+                    step[step < 10] = 0.0
+                step[np.isnan(step)] = 0.0
+                describe_array(record, step)
+            yield step
 
     def calculate_nwc_linda(self):
         # Estimate the motion field with Lucas-Kanade
@@ -45,4 +117,105 @@ class ExtrapolatedNWC:
                                            vel_pert_method=None, add_perturbations=False)
             self.data[self.data < 10] = 0.0
         else:
-            self.data = linda.forecast(self.data_input[-1, :, :], self.V, self.n_leadtimes)
\ No newline at end of file
+            self.data = linda.forecast(self.data_input[-1, :, :], self.V, self.n_leadtimes)
+
+
+class EnsembleNWC:
+    """Ensemble POT nowcast with LINDA, reduced to probability fields on the fly
+
+    Members are computed in batches of members_per_task in a process pool, with at most
+    one batch per worker in flight, so memory stays bounded by the number of workers.
+    Each finished batch is reduced into the exceedance count and mean. If percentiles
+    are requested, members are spilled (as uint8 percentages) to a temporary memory
+    mapped file, and percentiles are computed one lead time at a time from it.
+    data is the probability (%) of POT exceeding threshold, like other nowcasts it
+    has shape (n_leadtimes, ny, nx).
+    """
+    def __init__(self, data: np.array,
+                 nodata: np.array,
+                 pot_data: np.array,
+                 n_leadtimes: int = 17,
+                 n_members: int = 10,
+                 workers: int = 1,
+                 members_per_task: int = 2,
+                 threshold: float = 10,
+                 percentiles: list = None,
+                 seed: int = 0,
+                 motion_factor: int = 1):
+        self.data_input = data
+        self.nodata = nodata
+        self.pot = pot_data
+        self.n_leadtimes = n_leadtimes
+        self.n_members = n_members
+        self.workers = workers
+        self.members_per_task = members_per_task
+        self.threshold = threshold
+        self.percentile_levels = percentiles or []
+        self.seed = seed
+        self.motion_factor = motion_factor
+        self.V = None
+        self.data = None
+        self.mean = None
+        self.percentiles = {}
+        self.calculate_ensemble()
+
+    def calculate_ensemble(self):
+        with span("motion_estimation") as record:
+            describe_array(record, self.data_input)
+            self.V = tl.calculate_wind_field(self.data_input, self.nodata, self.motion_factor)
+        pot = self.pot[-1, :, :] if self.pot.ndim == 3 else self.pot
+        zeros = np.zeros(pot.shape)
+        linda_input = np.array([zeros, zeros, pot])
+        batches = [min(self.members_per_task, self.n_members - i)
+                   for i in range(0, self.n_members, self.members_per_task)]
+        exceedances = np.zeros((self.n_leadtimes,) + pot.shape, dtype=np.uint16)
+        total = np.zeros((self.n_leadtimes,) + pot.shape, dtype=np.float32)
+        with tempfile.TemporaryFile(prefix="thundercast_members_") as spill:
+            members = None
+            if len(self.percentile_levels) > 0:
+                members = np.memmap(spill, dtype=np.uint8, mode="w+",
+                                    shape=(self.n_members, self.n_leadtimes) + pot.shape)
+            n_reduced = 0
+            with span("ensemble", members=self.n_members, workers=self.workers):
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    pending = collections.deque()
+                    for task, n_members in enumerate(batches):
+                        pending.append(executor.submit(linda_members, linda_input, self.V, self.n_leadtimes,
+                                                       n_members, self.seed + task))
+                        if len(pending) >= self.workers:
+                            n_reduced = self.reduce(pending.popleft().result(), exceedances, total,
+                                                    members, n_reduced)
+                    while len(pending) > 0:
+                        n_reduced = self.reduce(pending.popleft().result(), exceedances, total, members, n_reduced)
+            self.data = 100.0 * exceedances / self.n_members
+            self.mean = total / self.n_members
+            if members is not None:
+                self.calculate_percentiles(members)
+                del members
+
+    def reduce(self, batch, exceedances, total, members, n_reduced) -> int:
+        """Add batch to the statistics and to members at n_reduced, returns the new member count"""
+        batch[~np.isfinite(batch)] = 0.0
+        batch[batch < 10] = 0.0
+        exceedances += np.sum(batch >= self.threshold, axis=0, dtype=np.uint16)
+        total += np.sum(batch, axis=0)
+        if members is not None:
+            members[n_reduced:n_reduced + len(batch)] = np.clip(np.round(batch), 0, 100).astype(np.uint8)
+        return n_reduced + len(batch)
+
+    def calculate_percentiles(self, members):
+        """Percentiles of spilled members, reading one lead time of all members at a time"""
+        with span("ensemble_percentiles", percentiles=len(self.percentile_levels)):
+            for p in self.percentile_levels:
+                self.percentiles[p] = np.empty(members.shape[1:], dtype=np.float32)
+            for i in range(self.n_leadtimes):
+                fields = np.percentile(members[:, i], self.percentile_levels, axis=0)
+                for p, field in zip(self.percentile_levels, fields):
+                    self.percentiles[p][i] = field
+
+
+def linda_members(linda_input, V, n_leadtimes, n_members, seed):
+    """Run n_members perturbed LINDA members, returns (n_members, n_leadtimes, ny, nx)"""
+    members = linda.forecast(linda_input, V, n_leadtimes, "domain", n_ens_members=n_members,
+                             kmperpixel=1.0, timestep=15, seed=seed, num_workers=1)
+    return np.reshape(members, (n_members, n_leadtimes) + linda_input.shape[1:])
@@ -1,7 +1,9 @@
 import os
 import numpy as np
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
+from matplotlib import animation
 from datetime import datetime as dt
 from datetime import timedelta as td
 from mpl_toolkits.basemap import Basemap
@@ -38,8 +40,13 @@ def main():
         if len(flash_obs) == 0:
             flash_obs = None
 
-    plot_contourf_map_scandinavia(args.data_file, fig_out, "Probability of thunder mnwc 15min 1km, model base",
-                                  obs=flash_obs, wind=wind)
+    title = "Probability of thunder mnwc 15min 1km, model base"
+    if args.animation is not None:
+        animate_map_scandinavia(args.data_file, args.animation, title, obs=flash_obs, wind=wind,
+                                dpi=args.dpi, fps=args.fps)
+    else:
+        plot_contourf_map_scandinavia(args.data_file, fig_out, title,
+                                      obs=flash_obs, wind=wind, workers=args.workers, dpi=args.dpi)
 
 
 def parse_command_line():
@@ -51,55 +58,129 @@ def parse_command_line():
     parser.add_argument("--rprate_1_file", action="store", type=str, required=False)
     parser.add_argument("--rprate_2_file", action="store", type=str, required=False)
     parser.add_argument("--rprate_3_file", action="store", type=str, required=False)
+    parser.add_argument("--workers", action="store", type=int, default=1,
+                        help="Number of processes rendering the frames")
+    parser.add_argument("--dpi", action="store", type=int, default=300)
+    parser.add_argument("--animation", action="store", type=str, default=None,
+                        help="Write one .mp4 or .gif animation instead of png files")
+    parser.add_argument("--fps", action="store", type=int, default=2,
+                        help="Frames per second of the animation")
     args = parser.parse_args()
     return args
 
 
 def plot_contourf_map_scandinavia(data, outfile, title, obs=None,
-                                       wind=None, vmin=0, vmax=100):
+                                       wind=None, vmin=0, vmax=100, workers=1, dpi=300):
     """Use for plotting when projection is Lambert etc.
 
+    Projection, background features and the mesh are built once per worker and only
+    the data of the mesh is changed between the frames. Frames are split evenly over
+    workers processes.
     For xarray to work with grib-files, cfgrib must be installed
     """
     if isinstance(data, str):
         data = ReadData(data, read_coordinates=True, time_steps=16)
         data.data = tl.mask_missing_data(data.data, data.mask_nodata)
-    lon = data.longitudes
+    # Coordinates may be shared with other readers, so do not modify them in place
+    lon = np.where(data.longitudes > 180, data.longitudes - 360, data.longitudes)
     lat = data.latitudes
-    fig_date = data.analysis_time
-    for i, data_field in enumerate(data.data):
-        minute = 0
-        if i > 0:
+    chunks = [c for c in np.array_split(np.arange(len(data.data)), workers) if len(c) > 0]
+    tasks = [(list(c), data.data[c], lon, lat, data.analysis_time, outfile, title, obs, wind, vmin, vmax, dpi,
+              len(data.data)) for c in chunks]
+    if len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            list(executor.map(render_frames, *zip(*tasks)))
+    else:
+        render_frames(*tasks[0])
+
+
+def render_frames(indices, fields, lon, lat, analysis_time, outfile, title, obs=None,
+                  wind=None, vmin=0, vmax=100, dpi=300, n_frames=17):
+    """Render frames of given lead time indices to png files with one figure"""
+    fig, ax, cm, quiver = setup_map_figure(lon, lat, fields[0], wind_at(wind, indices[0]), vmin, vmax)
+    for i, data_field in zip(indices, fields):
+        minute = 15 * i
+        fig_date = analysis_time + td(minutes=minute)
+        update_map_figure(cm, quiver, data_field, wind_at(wind, i))
+        scatter = None
+        if i == 0 and obs is not None:
+            lons = obs['longitude']
+            lats = obs['latitude']
+            scatter = ax.scatter(lons, lats, zorder=1, alpha=0.3, c='r', s=3,
+                                 transform=cartopy.crs.PlateCarree())
+        ax.set_title(f"{title} {dt.strftime(fig_date, '%Y-%m-%d %H:%M')},\n Analysistime {analysis_time}, forecast + {minute}min)")
+        forecast_outfile = outfile + f"POT_{i}_{dt.strftime(analysis_time, '%Y%m%d%H%M')}+{i*15}min.png"
+        fig.savefig(forecast_outfile, bbox_inches='tight', pad_inches=0.2, dpi=dpi)
+        if scatter is not None:
+            scatter.remove()
+        print(f"Done plotting fig {i+1}/{n_frames})")
+    plt.close(fig)
+
+
+def animate_map_scandinavia(data, outfile, title, obs=None, wind=None, vmin=0, vmax=100,
+                            dpi=100, fps=2, figsize=(8, 8)):
+    """Write all lead times as one animation (.mp4 with ffmpeg, .gif with pillow)
+
+    One figure is kept for the whole animation, only the mesh and quiver data change
+    between frames, and frames are piped to the encoder without intermediate files.
+    wind can be one field (2, ny, nx) or one per lead time (n, 2, ny, nx).
+    """
+    if isinstance(data, str):
+        data = ReadData(data, read_coordinates=True, time_steps=16)
+        data.data = tl.mask_missing_data(data.data, data.mask_nodata)
+    lon = np.where(data.longitudes > 180, data.longitudes - 360, data.longitudes)
+    lat = data.latitudes
+    if outfile.endswith(".gif"):
+        writer = animation.PillowWriter(fps=fps)
+    else:
+        writer = animation.FFMpegWriter(fps=fps)
+    fig, ax, cm, quiver = setup_map_figure(lon, lat, data.data[0], wind_at(wind, 0), vmin, vmax, figsize)
+    scatter = None
+    if obs is not None:
+        scatter = ax.scatter(obs['longitude'], obs['latitude'], zorder=1, alpha=0.3, c='r', s=3,
+                             transform=cartopy.crs.PlateCarree())
+    with writer.saving(fig, outfile, dpi):
+        for i, data_field in enumerate(data.data):
             minute = 15 * i
-            fig_date = fig_date + td(minutes=int(15))
-        lon[lon > 180] = lon[lon > 180] - 360
-        proj = cartopy.crs.LambertConformal(central_latitude=int(np.mean(lat)),
-                                            central_longitude=int(np.mean(lon)),
-                                            standard_parallels=(25, 25))
-        ax = generate_fig(proj)
-        if i == 0:
-            cm = ax.pcolormesh(lon, lat, data_field, transform=cartopy.crs.PlateCarree(),
-                               shading='auto', vmin=vmin, vmax=vmax, cmap='Blues')
-            if obs is not None:
-                lons = obs['longitude']
-                lats = obs['latitude']
-                ax.scatter(lons, lats, zorder=1, alpha=0.3, c='r', s=3,
-                           transform=cartopy.crs.PlateCarree())
-            if wind is not None:
-                ax.quiver(lon[::100, ::100], lat[::100, ::100], wind[0][::100, ::100],
-                          wind[-1][::100, ::100], transform=cartopy.crs.PlateCarree())
-        else:
-            cm = ax.pcolormesh(lon, lat, data_field, transform=cartopy.crs.PlateCarree(),
-                               shading='auto', vmin=vmin, vmax=vmax, cmap='Blues')
-            if wind is not None:
-                ax.quiver(lon[::100, ::100], lat[::100, ::100], wind[0][::100, ::100],
-                          wind[-1][::100, ::100], transform=cartopy.crs.PlateCarree())
-        plt.title(f"{title} {dt.strftime(fig_date, '%Y-%m-%d %H:%M')},\n Analysistime {data.analysis_time}, forecast + {minute}min)")
-        plt.colorbar(cm, fraction=0.046, pad=0.04, orientation="horizontal")
-        forecast_outfile = outfile + f"POT_{i}_{dt.strftime(data.analysis_time, '%Y%m%d%H%M')}+{i*15}min.png"
-        plt.savefig(forecast_outfile, bbox_inches='tight', pad_inches=0.2, dpi=300)
-        plt.close()
-        print(f"Done plotting fig {i+1}/17)")
+            fig_date = data.analysis_time + td(minutes=minute)
+            update_map_figure(cm, quiver, data_field, wind_at(wind, i))
+            if i == 1 and scatter is not None:
+                # Observations are shown on analysis frame only
+                scatter.remove()
+            ax.set_title(f"{title} {dt.strftime(fig_date, '%Y-%m-%d %H:%M')},\n Analysistime {data.analysis_time}, forecast + {minute}min)")
+            writer.grab_frame()
+    plt.close(fig)
+    print(f"Wrote animation {outfile}")
+
+
+def setup_map_figure(lon, lat, data_field, wind=None, vmin=0, vmax=100, figsize=None):
+    """Figure with projection, background, mesh and quiver which are reused for every frame"""
+    proj = cartopy.crs.LambertConformal(central_latitude=int(np.mean(lat)),
+                                        central_longitude=int(np.mean(lon)),
+                                        standard_parallels=(25, 25))
+    fig = plt.figure(figsize=figsize)
+    ax = generate_fig(proj)
+    cm = ax.pcolormesh(lon, lat, data_field, transform=cartopy.crs.PlateCarree(),
+                       shading='auto', vmin=vmin, vmax=vmax, cmap='Blues')
+    quiver = None
+    if wind is not None:
+        quiver = ax.quiver(lon[::100, ::100], lat[::100, ::100], wind[0][::100, ::100],
+                           wind[-1][::100, ::100], transform=cartopy.crs.PlateCarree())
+    plt.colorbar(cm, fraction=0.046, pad=0.04, orientation="horizontal")
+    return fig, ax, cm, quiver
+
+
+def update_map_figure(cm, quiver, data_field, wind=None):
+    cm.set_array(data_field)
+    if quiver is not None and wind is not None:
+        quiver.set_UVC(wind[0][::100, ::100], wind[-1][::100, ::100])
+
+
+def wind_at(wind, i):
+    """Wind field of lead time i, wind is either static or given per lead time"""
+    if wind is None or np.ndim(wind) < 4:
+        return wind
+    return wind[i]
 
 
 def plot_NWC_data_imshow_polster(data, outfile, title, obs=None,
@@ -0,0 +1,210 @@
+import os
+import shutil
+import hashlib
+import weakref
+import tempfile
+import threading
+import fsspec
+from telemetry import span
+
+# Bytes read from S3 per request when streaming an object
+STREAM_BLOCK_SIZE = 8 * 1024 ** 2
+
+
+class S3Reader:
+    """Reads grib files from S3 through one shared filesystem and a local LRU file cache
+
+    Objects are cached under cache_dir by path and ETag, so an object is downloaded
+    only once even between cycles, and a rewritten object is downloaded again in the
+    next cycle, ETags are looked up once per object and cycle. The
+    cache is limited to max_bytes, least recently used objects are removed first.
+    Messages can also be decoded while the object is still being transferred, see
+    messages(), and single messages read with range requests, see read_range().
+    """
+    def __init__(self, cache_dir: str = None, max_bytes: int = 4 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        if self.cache_dir is None:
+            # Without a configured cache directory objects are cached only for the lifetime of the process
+            self.cache_dir = tempfile.mkdtemp(prefix="thundercast_s3_")
+            weakref.finalize(self, shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.fs = None
+        # Cached paths handed out during the current cycle, never evicted
+        self.in_use = set()
+        # Cache paths of objects by S3 path, resolved once per cycle
+        self.paths = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def filesystem(self):
+        """Anonymous S3 filesystem, created once so its connection pool is shared by all reads"""
+        with self.lock:
+            if self.fs is None:
+                endpoint_url = os.environ.get('S3_HOSTNAME', 'https://routines-data-prod.lake.fmi.fi')
+                self.fs = fsspec.filesystem("s3", anon=True, client_kwargs={'endpoint_url': endpoint_url})
+            return self.fs
+
+    def cache_path(self, data_file: str) -> str:
+        """Path of data_file in the cache, raises FileNotFoundError if there is no such object"""
+        with self.lock:
+            if data_file in self.paths:
+                return self.paths[data_file]
+        etag = self.filesystem.info(data_file).get("ETag", "").strip('"')
+        name = hashlib.md5(f"{data_file}:{etag}".encode()).hexdigest()
+        path = os.path.join(self.cache_dir, name + os.path.splitext(data_file)[1])
+        with self.lock:
+            self.paths[data_file] = path
+        return path
+
+    def cached(self, data_file: str):
+        """Path of data_file if it is already in the cache, otherwise None"""
+        path = self.cache_path(data_file)
+        with self.lock:
+            if not os.path.isfile(path):
+                return None
+            # Modification time is used as last access time for eviction
+            os.utime(path)
+            self.in_use.add(path)
+        return path
+
+    def new_cycle(self):
+        """Allow eviction of paths handed out during the previous cycle, and look up ETags again"""
+        with self.lock:
+            self.in_use.clear()
+            self.paths.clear()
+
+    def local_path(self, data_file: str) -> str:
+        """Download data_file to the cache unless it is there already, return the cached path"""
+        path = self.cached(data_file)
+        if path is not None:
+            return path
+        path = self.cache_path(data_file)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with span("s3_download", file=data_file) as record:
+            try:
+                self.filesystem.get_file(data_file, tmp_path)
+                with self.lock:
+                    os.replace(tmp_path, path)
+                    self.in_use.add(path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            record["bytes"] = os.path.getsize(path)
+        self.evict()
+        return path
+
+    def messages(self, data_file: str):
+        """Yield (offset, message bytes) of grib messages of data_file as soon as each has arrived
+
+        A cached object is read from the cache. Otherwise the object is streamed and
+        written to the cache, which is completed only if all messages are consumed.
+        """
+        path = self.cached(data_file)
+        if path is not None:
+            with open(path, "rb") as fp:
+                yield from split_grib_messages(fp)
+            return
+        path = self.cache_path(data_file)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with span("s3_download", file=data_file) as record:
+            try:
+                with self.filesystem.open(data_file, "rb", block_size=STREAM_BLOCK_SIZE) as fp, \
+                        open(tmp_path, "wb") as cache_fp:
+                    yield from split_grib_messages(TeeReader(fp, cache_fp))
+                with self.lock:
+                    os.replace(tmp_path, path)
+                    self.in_use.add(path)
+                record["bytes"] = os.path.getsize(path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        self.evict()
+
+    def read_range(self, data_file: str, start: int, end: int) -> bytes:
+        """Bytes [start, end) of data_file, from the cache if the object is there"""
+        path = self.cached(data_file)
+        if path is not None:
+            with open(path, "rb") as fp:
+                fp.seek(start)
+                return fp.read(end - start)
+        return self.filesystem.cat_file(data_file, start=start, end=end)
+
+    def evict(self):
+        """Remove least recently used objects until cache fits to max_bytes
+
+        Objects handed out during the current cycle are kept, and files removed
+        by another process meanwhile are skipped.
+        """
+        with self.lock:
+            files = []
+            for f in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, f)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            files.sort()
+            total = sum(size for mtime, size, path in files)
+            for mtime, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                if path.endswith(".tmp") or path in self.in_use:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class TeeReader:
+    """File-like object reading from fp and copying everything read to out"""
+    def __init__(self, fp, out):
+        self.fp = fp
+        self.out = out
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fp.read(size)
+        self.out.write(data)
+        return data
+
+
+def split_grib_messages(fp, block_size: int = STREAM_BLOCK_SIZE):
+    """Yield (offset, message bytes) of grib messages in file-like fp, reading block_size at a time
+
+    Message length comes from the indicator section, bytes 8-15 in edition 2 and
+    bytes 4-6 in edition 1, so a message is complete as soon as its bytes are read.
+    """
+    buffer = bytearray()
+    offset = 0
+    eof = False
+    while True:
+        start = buffer.find(b"GRIB")
+        if start < 0 and eof:
+            return
+        if start > 0:
+            # Skip bytes between messages
+            del buffer[:start]
+            offset += start
+        if start >= 0 and len(buffer) >= 16:
+            if buffer[7] == 2:
+                length = int.from_bytes(buffer[8:16], "big")
+            else:
+                length = int.from_bytes(buffer[4:7], "big")
+            if len(buffer) >= length:
+                yield offset, bytes(buffer[:length])
+                del buffer[:length]
+                offset += length
+                continue
+        if eof:
+            raise ValueError(f"Truncated grib message at offset {offset}")
+        if start < 0 and len(buffer) > 3:
+            # Keep the tail in case "GRIB" is split between blocks
+            offset += len(buffer) - 3
+            del buffer[:-3]
+        data = fp.read(block_size)
+        if len(data) == 0:
+            eof = True
+        buffer += data
@@ -0,0 +1,101 @@
+import queue
+import threading
+import fsspec
+from concurrent.futures import Future
+from telemetry import span
+
+# Parts of an S3 multipart upload, except the last one, must be at least 5 MB
+MIN_PART_SIZE = 5 * 1024 ** 2
+# Uploads started by this process and not yet waited for
+PENDING_UPLOADS = []
+ABORT = object()
+
+
+class S3UploadSink:
+    """Write-only file-like object uploading everything written to it to S3 in the background
+
+    Written bytes are queued to a thread writing them to an s3fs file, which sends every
+    part_size bytes as one part of a multipart upload, so most of the file is uploaded
+    while later messages are still being encoded. close() returns at once, upload is a
+    Future completed when the object is in S3, or failed if the upload failed. On
+    failure or abort() the multipart upload is discarded, no partial object is left.
+    """
+    def __init__(self, output_file: str, s3_options: dict, part_size: int = MIN_PART_SIZE,
+                 max_queued: int = 64):
+        self.output_file = output_file
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.upload = Future()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, args=(s3_options,), name=f"upload {output_file}")
+        self.thread.start()
+        PENDING_UPLOADS.append(self)
+
+    def write(self, data) -> int:
+        if self.upload.done():
+            # Upload has failed, the exception is raised to the writer
+            self.upload.result()
+        self.queue.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        # Parts are sent when part_size bytes have been written
+        pass
+
+    def close(self):
+        """Finish the upload in the background"""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+
+    def abort(self):
+        """Discard everything written so far"""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(ABORT)
+
+    def run(self, s3_options: dict):
+        self.upload.set_running_or_notify_cancel()
+        fp = None
+        n_bytes = 0
+        try:
+            with span("upload", file=self.output_file) as record:
+                fs = fsspec.filesystem("s3", **s3_options)
+                fp = fs.open(self.output_file, "wb", block_size=self.part_size)
+                while True:
+                    data = self.queue.get()
+                    if data is None:
+                        break
+                    if data is ABORT:
+                        raise RuntimeError(f"Upload of {self.output_file} aborted")
+                    fp.write(data)
+                    n_bytes += len(data)
+                fp.close()
+                record["bytes"] = n_bytes
+            print("wrote file '%s'" % self.output_file)
+            self.upload.set_result(self.output_file)
+        except BaseException as e:
+            if fp is not None and not fp.closed:
+                fp.discard()
+                # Discarded file is unusable, it must not try to upload on garbage collection
+                fp.closed = True
+            self.upload.set_exception(e)
+            # Release a writer waiting for room in the queue, until it closes the sink
+            while not self.closed or not self.queue.empty():
+                try:
+                    self.queue.get(timeout=1)
+                except queue.Empty:
+                    pass
+
+
+def wait_for_uploads() -> list:
+    """Wait for all pending uploads to finish, return output files of the failed ones"""
+    failed = []
+    while len(PENDING_UPLOADS) > 0:
+        sink = PENDING_UPLOADS.pop(0)
+        try:
+            sink.upload.result()
+        except Exception as e:
+            print(f"Upload of {sink.output_file} failed: {e}")
+            failed.append(sink.output_file)
+    return failed
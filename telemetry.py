@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class Tracer:
+    """Per-stage timing of nowcast cycles
+
+    Each span records wall time, CPU time of the calling thread and whatever the stage
+    adds to its record, e.g. bytes moved (bytes) and size of arrays handled
+    (array_bytes), which are counted separately. Spans of a cycle are emitted as one
+    JSON record, and stage totals are kept as counters that can be written in
+    Prometheus text format.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cycle = None
+        self.cycle_start = None
+        self.spans = []
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.array_bytes = defaultdict(int)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        record = dict(attributes, name=name)
+        start_wall, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - start_wall
+            record["cpu_seconds"] = time.thread_time() - start_cpu
+            with self.lock:
+                self.spans.append(record)
+                self.seconds[name] += record["wall_seconds"]
+                self.calls[name] += 1
+                self.bytes[name] += record.get("bytes", 0)
+                self.array_bytes[name] += record.get("array_bytes", 0)
+
+    def start_cycle(self, cycle: str):
+        with self.lock:
+            self.cycle = cycle
+            self.cycle_start = time.perf_counter()
+            self.spans = []
+
+    def end_cycle(self, path: str = None, status: str = "ok") -> dict:
+        """Emit JSON record of the cycle as one line to path, or to stdout if path is None"""
+        with self.lock:
+            record = {"cycle": self.cycle, "status": status,
+                      "wall_seconds": time.perf_counter() - self.cycle_start,
+                      "spans": self.spans}
+            self.spans = []
+        line = json.dumps(record, default=str)
+        if path is None:
+            print(line, file=sys.stdout)
+        else:
+            with open(path, "a") as fp:
+                fp.write(line + "\n")
+        return record
+
+    def prometheus_text(self) -> str:
+        lines = ["# TYPE thundercast_stage_seconds_total counter"]
+        with self.lock:
+            lines += [f'thundercast_stage_seconds_total{{stage="{s}"}} {v}' for s, v in sorted(self.seconds.items())]
+            lines.append("# TYPE thundercast_stage_calls_total counter")
+            lines += [f'thundercast_stage_calls_total{{stage="{s}"}} {v}' for s, v in sorted(self.calls.items())]
+            lines.append("# TYPE thundercast_stage_bytes_total counter")
+            lines += [f'thundercast_stage_bytes_total{{stage="{s}"}} {v}' for s, v in sorted(self.bytes.items())]
+            lines.append("# TYPE thundercast_stage_array_bytes_total counter")
+            lines += [f'thundercast_stage_array_bytes_total{{stage="{s}"}} {v}'
+                      for s, v in sorted(self.array_bytes.items())]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Write counters for e.g. node exporter textfile collector"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+def describe_array(record: dict, array):
+    """Add shape, dtype and size of array to a span record, size is kept apart from bytes moved"""
+    record["shape"] = list(array.shape)
+    record["dtype"] = str(array.dtype)
+    record["array_bytes"] = record.get("array_bytes", 0) + int(array.nbytes)
+
+
+TRACER = Tracer()
+span = TRACER.span
@@ -0,0 +1,30 @@
+import os
+import sys
+import pytest
+
+# Modules of the repository are imported as top-level modules, like the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def s3_endpoint():
+    """Endpoint URL of a local moto S3 stand-in with an empty bucket "thundercast" """
+    reason = "S3 reader and upload tests need moto[server] and boto3, see README"
+    server_module = pytest.importorskip("moto.server", reason=reason)
+    boto3 = pytest.importorskip("boto3", reason=reason)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    server = server_module.ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint = f"http://{host}:{port}"
+    boto3.client("s3", endpoint_url=endpoint).create_bucket(Bucket="thundercast")
+    yield endpoint
+    server.stop()
+
+
+@pytest.fixture
+def s3_client(s3_endpoint):
+    import boto3
+    return boto3.client("s3", endpoint_url=s3_endpoint)
@@ -0,0 +1,94 @@
+import json
+import threading
+from datetime import datetime as dt
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+from flash_obs import FlashObservationClient, epoch, FLASH_PARAMS
+
+
+class SmartmetStandIn(HTTPServer):
+    """Local smartmet timeseries server answering flash queries from a fixed list"""
+    def __init__(self, flashes):
+        super().__init__(("127.0.0.1", 0), SmartmetHandler)
+        self.flashes = flashes
+        self.requests = []
+
+
+class SmartmetHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        self.server.requests.append(query)
+        start = epoch(dt.strptime(query["starttime"], "%Y-%m-%dT%H:%M:%S"))
+        end = epoch(dt.strptime(query["endtime"], "%Y-%m-%dT%H:%M:%S"))
+        # Smartmet time range is inclusive at both ends
+        rows = [f for f in self.server.flashes if start <= f[3] <= end]
+        body = json.dumps([dict(zip(FLASH_PARAMS, row)) for row in rows]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def flash(flash_id, time):
+    return [flash_id, 25.0, 60.0, epoch(dt.strptime(time, "%Y%m%d%H%M%S")), 0.0, -10.0]
+
+
+@pytest.fixture
+def server():
+    flashes = [flash(1, "20230701111959"),
+               flash(2, "20230701112000"),
+               flash(3, "20230701113959"),
+               flash(4, "20230701114000"),
+               flash(5, "20230701120000"),
+               flash(6, "20230701120001"),
+               flash(7, "20230701121000")]
+    server = SmartmetStandIn(flashes)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def client_for(server):
+    return FlashObservationClient(url=f"http://127.0.0.1:{server.server_address[1]}/timeseries", retries=0)
+
+
+def weights(obs):
+    return dict(zip(obs["station_id"], obs["flash"]))
+
+
+def test_recent_and_older_window_weights(server):
+    obs = client_for(server).read("202307011200", 20)
+    # Older window starts at 11:20, recent one at 11:40 and both end times are inclusive
+    assert weights(obs) == {2: 40.0, 3: 40.0, 4: 100.0, 5: 100.0}
+    assert (obs["elevation"] == 0.0).all()
+    assert len(server.requests) == 1
+    assert server.requests[0]["starttime"] == "2023-07-01T11:20:00"
+    assert server.requests[0]["endtime"] == "2023-07-01T12:00:00"
+
+
+def test_next_cycle_fetches_only_unseen_minutes(server):
+    client = client_for(server)
+    client.read("202307011200", 20)
+    obs = client.read("202307011215", 20)
+    # Older window starts at 11:35, recent one at 11:55
+    assert weights(obs) == {3: 40.0, 4: 40.0, 5: 100.0, 6: 100.0, 7: 100.0}
+    # Buckets up to 12:00 were complete after the first cycle, bucket 12:00-12:10 was not
+    assert len(server.requests) == 2
+    assert server.requests[1]["starttime"] == "2023-07-01T12:00:00"
+    assert server.requests[1]["endtime"] == "2023-07-01T12:15:00"
+
+
+def test_same_cycle_again_does_not_fetch_complete_buckets(server):
+    client = client_for(server)
+    first = client.read("202307011200", 20)
+    second = client.read("202307011200", 20)
+    assert weights(first) == weights(second)
+    # Only the last, incomplete bucket 12:00-12:10 is fetched again
+    assert server.requests[1]["starttime"] == "2023-07-01T12:00:00"
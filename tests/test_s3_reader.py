@@ -0,0 +1,118 @@
+import io
+import gc
+import os
+import pytest
+from s3_reader import S3Reader, split_grib_messages
+
+
+def grib_message(length: int, edition: int = 2, fill: int = 1) -> bytes:
+    """Bytes shaped like a grib message: indicator section, filler and end section"""
+    if edition == 2:
+        indicator = b"GRIB" + b"\0\0\0\x02" + length.to_bytes(8, "big")
+    else:
+        indicator = b"GRIB" + length.to_bytes(3, "big") + b"\x01" + bytes(8)
+    return indicator + bytes([fill]) * (length - 20) + b"7777"
+
+
+MESSAGES = [grib_message(100, fill=1), grib_message(37, fill=2), grib_message(5000, edition=1, fill=3)]
+# Some bytes before and between the messages
+DATA = b"junk" + MESSAGES[0] + MESSAGES[1] + b"xx" + MESSAGES[2]
+OFFSETS = [4, 104, 143]
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 7, 64, 100000])
+def test_split_grib_messages(block_size):
+    messages = list(split_grib_messages(io.BytesIO(DATA), block_size))
+    assert [offset for offset, message in messages] == OFFSETS
+    assert [message for offset, message in messages] == MESSAGES
+
+
+def test_split_truncated_grib_message():
+    with pytest.raises(ValueError):
+        list(split_grib_messages(io.BytesIO(MESSAGES[0][:50]), 7))
+
+
+@pytest.fixture
+def reader(s3_endpoint, tmp_path, monkeypatch):
+    monkeypatch.setenv("S3_HOSTNAME", s3_endpoint)
+    return S3Reader(str(tmp_path / "cache"))
+
+
+def put(s3_client, key, data):
+    # Inputs are read anonymously, like from the FMI bucket
+    s3_client.put_object(Bucket="thundercast", Key=key, Body=data, ACL="public-read")
+    return f"s3://thundercast/{key}"
+
+
+def test_streamed_messages_fill_cache(reader, s3_client):
+    data_file = put(s3_client, "stream.grib2", DATA)
+    assert reader.cached(data_file) is None
+    assert list(reader.messages(data_file)) == list(zip(OFFSETS, MESSAGES))
+    with open(reader.cached(data_file), "rb") as fp:
+        assert fp.read() == DATA
+    # Second read comes from the cache
+    assert list(reader.messages(data_file)) == list(zip(OFFSETS, MESSAGES))
+
+
+def test_partially_read_stream_is_not_cached(reader, s3_client):
+    data_file = put(s3_client, "partial.grib2", DATA)
+    messages = reader.messages(data_file)
+    assert next(messages) == (OFFSETS[0], MESSAGES[0])
+    messages.close()
+    assert reader.cached(data_file) is None
+    assert os.listdir(reader.cache_dir) == []
+
+
+def test_read_range(reader, s3_client):
+    data_file = put(s3_client, "range.grib2", DATA)
+    # Range request to S3, then the same range from the cached copy
+    assert reader.read_range(data_file, OFFSETS[1], OFFSETS[1] + len(MESSAGES[1])) == MESSAGES[1]
+    reader.local_path(data_file)
+    assert reader.read_range(data_file, OFFSETS[1], OFFSETS[1] + len(MESSAGES[1])) == MESSAGES[1]
+
+
+def test_rewritten_object_is_downloaded_again(reader, s3_client):
+    data_file = put(s3_client, "rewritten.grib2", MESSAGES[0])
+    first = reader.local_path(data_file)
+    put(s3_client, "rewritten.grib2", MESSAGES[1])
+    # ETag is looked up again only in the next cycle
+    assert reader.local_path(data_file) == first
+    reader.new_cycle()
+    second = reader.local_path(data_file)
+    assert first != second
+    with open(second, "rb") as fp:
+        assert fp.read() == MESSAGES[1]
+
+
+def test_etag_is_looked_up_once_per_cycle(reader, s3_client, monkeypatch):
+    data_file = put(s3_client, "etag.grib2", DATA)
+    calls = []
+    info = reader.filesystem.info
+    monkeypatch.setattr(reader.filesystem, "info", lambda path: calls.append(path) or info(path))
+    reader.local_path(data_file)
+    reader.read_range(data_file, 0, 4)
+    reader.cached(data_file)
+    assert calls == [data_file]
+    reader.new_cycle()
+    reader.cached(data_file)
+    assert calls == [data_file, data_file]
+
+
+def test_eviction_keeps_paths_of_current_cycle(reader, s3_client):
+    reader.max_bytes = len(DATA) + 1
+    paths = [reader.local_path(put(s3_client, f"evict{i}.grib2", DATA)) for i in range(2)]
+    # Over the limit, but both files were handed out in this cycle
+    assert all(os.path.isfile(p) for p in paths)
+    reader.new_cycle()
+    newest = reader.local_path(put(s3_client, "evict2.grib2", DATA))
+    assert not any(os.path.isfile(p) for p in paths)
+    assert os.path.isfile(newest)
+
+
+def test_temporary_cache_is_removed(s3_endpoint):
+    reader = S3Reader()
+    cache_dir = reader.cache_dir
+    assert os.path.isdir(cache_dir)
+    del reader
+    gc.collect()
+    assert not os.path.exists(cache_dir)
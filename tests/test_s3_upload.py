@@ -0,0 +1,45 @@
+import os
+import pytest
+from s3_upload import S3UploadSink, MIN_PART_SIZE, wait_for_uploads
+
+
+@pytest.fixture
+def s3_options(s3_endpoint):
+    # Nothing pending from earlier tests
+    wait_for_uploads()
+    return {"key": "testing", "secret": "testing", "client_kwargs": {"endpoint_url": s3_endpoint}}
+
+
+def test_multipart_upload(s3_options, s3_client):
+    data = os.urandom(MIN_PART_SIZE * 2 + 12345)
+    sink = S3UploadSink("s3://thundercast/multipart.grib2", s3_options)
+    for i in range(0, len(data), 1024 ** 2):
+        sink.write(data[i:i + 1024 ** 2])
+    sink.close()
+    assert sink.upload.result(timeout=60) == "s3://thundercast/multipart.grib2"
+    obj = s3_client.get_object(Bucket="thundercast", Key="multipart.grib2")
+    assert obj["Body"].read() == data
+    # ETag of a multipart upload ends with the number of parts
+    assert obj["ETag"].strip('"').endswith("-3")
+    assert wait_for_uploads() == []
+
+
+def test_abort_leaves_no_object(s3_options, s3_client):
+    sink = S3UploadSink("s3://thundercast/aborted.grib2", s3_options)
+    sink.write(os.urandom(MIN_PART_SIZE + 1))
+    sink.abort()
+    with pytest.raises(RuntimeError):
+        sink.upload.result(timeout=60)
+    assert s3_client.list_objects_v2(Bucket="thundercast", Prefix="aborted").get("KeyCount", 0) == 0
+    assert wait_for_uploads() == ["s3://thundercast/aborted.grib2"]
+
+
+def test_failed_upload_unblocks_writer(s3_options):
+    sink = S3UploadSink("s3://no-such-bucket/failed.grib2", s3_options, max_queued=2)
+    chunk = os.urandom(1024 ** 2)
+    with pytest.raises(Exception):
+        # Far more than the queue holds, so the writer would block forever if it was not released
+        for i in range(200):
+            sink.write(chunk)
+    sink.abort()
+    assert wait_for_uploads() == ["s3://no-such-bucket/failed.grib2"]
@@ -0,0 +1,110 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pysteps import nowcasts, motion
+import tools as tl
+
+# Window size of pysteps Lucas-Kanade feature tracking, in pixels
+LK_WINDOW = 15
+# Grid coarsening of the whole domain motion estimate sizing the halo of motion tiles
+HALO_FACTOR = 4
+
+
+def split_tiles(shape: tuple, tiles: tuple) -> list:
+    """Split 2D shape to tiles[0] x tiles[1] core boxes (y0, y1, x0, x1)"""
+    y_edges = np.linspace(0, shape[0], tiles[0] + 1).astype(int)
+    x_edges = np.linspace(0, shape[1], tiles[1] + 1).astype(int)
+    return [(y_edges[i], y_edges[i + 1], x_edges[j], x_edges[j + 1])
+            for i in range(tiles[0]) for j in range(tiles[1])]
+
+
+def pad_box(box: tuple, halo: int, shape: tuple) -> tuple:
+    """Grow core box by halo pixels to every side, limited to the domain"""
+    y0, y1, x0, x1 = box
+    return max(y0 - halo, 0), min(y1 + halo, shape[0]), max(x0 - halo, 0), min(x1 + halo, shape[1])
+
+
+def taper(box: tuple, padded: tuple, halo: int) -> np.array:
+    """Weight of a padded tile, 1 in the core and decreasing linearly to 0 over the halo"""
+    y0, y1, x0, x1 = box
+    py0, py1, px0, px1 = padded
+    y = np.arange(py0, py1)
+    x = np.arange(px0, px1)
+    # Distance outside the core, at the domain edges there is no halo and so no taper
+    dy = np.maximum(np.maximum(y0 - y, y - (y1 - 1)), 0)
+    dx = np.maximum(np.maximum(x0 - x, x - (x1 - 1)), 0)
+    wy = 1.0 - dy / (halo + 1.0)
+    wx = 1.0 - dx / (halo + 1.0)
+    return np.outer(wy, wx)
+
+
+def tile_wind_field(tile_data, factor=1):
+    return tl.calculate_wind_field(tile_data, None, factor)
+
+
+def tile_extrapolation(args):
+    field, V, n_leadtimes = args
+    extrapolate = nowcasts.get_method("extrapolation")
+    return extrapolate(field, V, n_leadtimes)
+
+
+def motion_halo(data: np.array, factor: int = HALO_FACTOR) -> int:
+    """Halo (pixels) covering the maximum displacement between frames of data, plus the LK window
+
+    Displacement is estimated on a factor times coarser grid of the whole domain, which
+    is cheap compared to the tiles themselves.
+    """
+    V = motion.get_method("LK")(tl.block_average(data[:3, :, :], factor))
+    max_displacement = np.nanmax(np.hypot(V[0], V[1])) * factor if np.any(np.isfinite(V)) else 0
+    return int(np.ceil(max_displacement)) + factor + LK_WINDOW
+
+
+def tiled_wind_field(data: np.array, nodata, tiles: tuple, workers: int = 1, halo: int = None,
+                     factor: int = 1) -> np.array:
+    """Lucas-Kanade motion field estimated per overlapping tile in a process pool
+
+    Tiles overlap by halo pixels, by default sized from the maximum displacement, see
+    motion_halo, and are blended with linear weights over the overlap, so there are no
+    seams at the tile borders.
+    """
+    if nodata is not None:
+        data[~np.isfinite(nodata)] = np.nan
+    data[data == 9999] = np.nan
+    shape = data.shape[1:]
+    if halo is None:
+        halo = motion_halo(data)
+    boxes = split_tiles(shape, tiles)
+    padded = [pad_box(box, halo, shape) for box in boxes]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tile_V = list(executor.map(tile_wind_field, [data[:, py0:py1, px0:px1] for py0, py1, px0, px1 in padded],
+                                   [factor] * len(padded)))
+    V = np.zeros((2,) + shape)
+    weights = np.zeros(shape)
+    for box, (py0, py1, px0, px1), tV in zip(boxes, padded, tile_V):
+        w = taper(box, (py0, py1, px0, px1), halo)
+        V[:, py0:py1, px0:px1] += w * tV
+        weights[py0:py1, px0:px1] += w
+    return V / weights
+
+
+def tiled_extrapolation(field: np.array, V: np.array, n_leadtimes: int, tiles: tuple, workers: int = 1) -> np.array:
+    """Semi-Lagrangian extrapolation per tile in a process pool
+
+    Halo of the tiles is the maximum displacement over the forecast horizon, so the
+    core of every tile is identical to extrapolating the whole domain at once.
+    """
+    shape = field.shape
+    halo = int(np.ceil(np.nanmax(np.hypot(V[0], V[1])) * n_leadtimes)) + 2
+    boxes = split_tiles(shape, tiles)
+    padded = [pad_box(box, halo, shape) for box in boxes]
+    tasks = [(field[py0:py1, px0:px1], V[:, py0:py1, px0:px1], n_leadtimes) for py0, py1, px0, px1 in padded]
+    output = np.empty((n_leadtimes,) + shape)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for (y0, y1, x0, x1), (py0, py1, px0, px1), tile in zip(boxes, padded, executor.map(tile_extrapolation, tasks)):
+            output[:, y0:y1, x0:x1] = tile[:, y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+    return output
+
+
+def parse_tiles(tiles: str) -> tuple:
+    """Parse tile layout like '2x3' to (2, 3)"""
+    ny, nx = tiles.lower().split("x")
+    return int(ny), int(nx)
@@ -1,5 +1,7 @@
 import os
 import datetime
+import time
+import resource
 import numpy as np
 import numpy.ma as ma
 from typing import Union
@@ -7,16 +9,17 @@ from dataclasses import dataclass
 from datetime import datetime as dt
 from datetime import timedelta as td
 import pandas as pd
-import fsspec
-import requests
+from flash_obs import FLASH_CLIENT
+from s3_reader import S3Reader
 import warnings
+from scipy import ndimage
 from pysteps import motion
 
 
 @dataclass
 class NWCData:
     data: np.array
-    mask: ma.masked_array
+    mask: Union[ma.masked_array, None]
     time: np.array
 
 
@@ -27,6 +30,18 @@ def generate_nowcast_array(analysis_info: dict):
     return nwc_data
 
 
+def stack_frames(frames: list, dtype=np.float32) -> NWCData:
+    """Stack 0h fields of frames into one preallocated array, without building masks
+
+    Missing data is set to nan in place, so no mask is needed later on.
+    """
+    stack = np.empty((len(frames),) + frames[0].data.shape[1:], dtype=dtype)
+    for i, frame in enumerate(frames):
+        stack[i] = frame.data[0]
+    clean_nodata(stack)
+    return NWCData(stack, None, np.asarray([frame.dtime[0] for frame in frames]))
+
+
 def create_dict(data):
     dict = {"data": [data.data[0]], "mask": [data.mask_nodata[0]], "time": [data.dtime[0]]}
     return dict
@@ -94,6 +109,23 @@ def round_current_time_in_quarter():
     return now.strftime("%Y%m%d%H%M")
 
 
+def next_cycle_time(now: dt, time_freq: int = 15) -> dt:
+    """Return the next quarter-hour (or other time_freq) boundary after now"""
+    boundary = dt(now.year, now.month, now.day, now.hour) + td(minutes=(now.minute // time_freq + 1) * time_freq)
+    return boundary
+
+
+def generate_cycle_file_paths(starttime: str, data_root: str, time_freq: int = 15):
+    """Generate input file paths of one cycle in the same layout as run_pot_nwc.sh
+
+    Returns rprate files from newest to oldest and the MNWC tstm file.
+    """
+    nwc_times = generate_nowcast_times(starttime, time_freq)
+    rprate_files = [f"{data_root}/{starttime}/{t}-hrnwc-rprate.grib2" for t in nwc_times]
+    mnwc_tstm_file = f"{data_root}/{starttime}/mnwc_tstm.grib2"
+    return rprate_files, mnwc_tstm_file
+
+
 def pick_analysis_data_from_array(data_object):
     data_0h = data_object.data[0, :, :]
     time_0h = data_object.dtime[0]
@@ -104,30 +136,165 @@ def pick_analysis_data_from_array(data_object):
 def convert_nan_to_zeros(data):
     nan_data = data.data
     for i in range(len(nan_data)):
-        nan_val = np.where(np.isnan(nan_data[i]))
-        nan_data[i][nan_val] = 0.0
+        # Boolean mask of one lead time at a time instead of index arrays
+        nan_data[i][np.isnan(nan_data[i])] = 0.0
     data.data = nan_data
     return data
 
 
+def clean_nodata(data: np.array, nodata: float = 9999) -> np.array:
+    """Set missing data to nan in place, same as mask_missing_data without a mask"""
+    data[data == nodata] = np.nan
+    return data
+
+
 def mask_missing_data(data: np.array, mask_nodata: np.array) -> np.array:
     data[~np.isfinite(mask_nodata)] = np.nan
     data[data == 9999] = np.nan
     return data
 
 
-def calculate_wind_field(data, nodata):
-    data[~np.isfinite(nodata)] = np.nan
+def calculate_wind_field(data, nodata, factor: int = 1):
+    """Lucas-Kanade motion field, estimated on a factor times coarser grid if factor > 1"""
+    if nodata is not None:
+        data[~np.isfinite(nodata)] = np.nan
     data[data == 9999] = np.nan
     oflow_method = motion.get_method("LK")
+    if factor > 1:
+        V = oflow_method(block_average(data[:3, :, :], factor))
+        return upsample_motion(V, factor, data.shape[1:])
     V = oflow_method(data[:3, :, :])
     return V
 
 
+def block_average(data: np.array, factor: int) -> np.array:
+    """Average (t, ny, nx) fields over factor x factor blocks, ignoring nan"""
+    t, ny, nx = data.shape
+    ny, nx = ny // factor * factor, nx // factor * factor
+    blocks = data[:, :ny, :nx].reshape(t, ny // factor, factor, nx // factor, factor)
+    with warnings.catch_warnings():
+        # Blocks with only missing data stay nan
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(2, 4))
+
+
+def upsample_motion(V: np.array, factor: int, shape: tuple) -> np.array:
+    """Interpolate coarse motion field to shape and rescale vectors to fine grid pixels"""
+    upsampled = np.empty((2,) + tuple(shape))
+    for i in range(2):
+        fine = ndimage.zoom(V[i], factor, order=1)[:shape[0], :shape[1]]
+        # Grid sizes not divisible by factor are padded with edge values
+        upsampled[i] = np.pad(fine, ((0, shape[0] - fine.shape[0]), (0, shape[1] - fine.shape[1])), mode="edge")
+    return upsampled * factor
+
+
+def compare_motion_fields(data: np.array, nodata, factors: list) -> dict:
+    """Compare coarse motion fields of each factor to the full resolution field
+
+    Returns vector RMSE (pixels per time step), RMSE relative to mean full resolution
+    speed and computation time of each factor.
+    """
+    start = time.time()
+    V_full = calculate_wind_field(data.copy(), nodata)
+    result = {1: {"rmse": 0.0, "relative_rmse": 0.0, "seconds": time.time() - start}}
+    mean_speed = np.nanmean(np.hypot(V_full[0], V_full[1]))
+    for factor in factors:
+        start = time.time()
+        V = calculate_wind_field(data.copy(), nodata, factor)
+        seconds = time.time() - start
+        rmse = float(np.sqrt(np.nanmean((V[0] - V_full[0]) ** 2 + (V[1] - V_full[1]) ** 2)))
+        result[factor] = {"rmse": rmse, "relative_rmse": rmse / mean_speed if mean_speed > 0 else np.nan,
+                          "seconds": seconds}
+    return result
+
+
+# Downloads started by prefetch_s3_files, keyed by S3 path
+S3_PREFETCHED = {}
+# True once reset_peak_memory has succeeded, report_peak_memory then reports per stage peaks
+PEAK_MEMORY_RESET = False
+# S3 objects are cached on local disk, in THUNDERCAST_S3_CACHE_DIR if set
+S3_READER = S3Reader(os.environ.get("THUNDERCAST_S3_CACHE_DIR"),
+                     int(os.environ.get("THUNDERCAST_S3_CACHE_MAX_MB", 4096)) * 1024 ** 2)
+
+
+def prefetch_s3_files(data_files: list, executor):
+    """Start downloading S3 files in executor, read_file_from_s3 then waits for the download
+
+    Only files read as a whole should be prefetched. Files without a .idx sidecar are
+    downloaded, the ones with it are left for byte range reads of single messages.
+    """
+    for data_file in data_files:
+        if data_file.startswith("s3://") and data_file not in S3_PREFETCHED:
+            S3_PREFETCHED[data_file] = executor.submit(download_unindexed_file_from_s3, data_file)
+
+
+def prefetched_file(data_file: str):
+    """Local path of a prefetched data_file after waiting for its download, None if it was not downloaded"""
+    if data_file in S3_PREFETCHED:
+        return S3_PREFETCHED.pop(data_file).result()
+    return None
+
+
+def reset_peak_memory() -> bool:
+    """Reset peak resident memory (VmHWM) of the process, possible only on Linux"""
+    global PEAK_MEMORY_RESET
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        PEAK_MEMORY_RESET = True
+    except OSError:
+        PEAK_MEMORY_RESET = False
+    return PEAK_MEMORY_RESET
+
+
+def peak_memory_mb() -> float:
+    """Peak resident memory (MB) since reset_peak_memory, or of the whole process if it was not reset"""
+    if PEAK_MEMORY_RESET:
+        with open("/proc/self/status") as fp:
+            return next(int(line.split()[1]) for line in fp if line.startswith("VmHWM:")) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report_peak_memory(stage: str, budget_mb: float = None):
+    """Print peak resident memory during stage, i.e. since the previous report, warn if over budget
+
+    Peak is reset after every report. Where that is not possible (not Linux) only the
+    peak of the whole process is known, and it is reported as such.
+    """
+    peak_mb = peak_memory_mb()
+    if PEAK_MEMORY_RESET:
+        label = "Peak memory during {}".format(stage)
+        reset_peak_memory()
+    else:
+        label = "Peak memory of the process after {}".format(stage)
+    print("{}: {:.0f} MB".format(label, peak_mb))
+    if budget_mb is not None and peak_mb > budget_mb:
+        warnings.warn("{} {:.0f} MB exceeds budget of {:.0f} MB".format(label, peak_mb, budget_mb))
+    return peak_mb
+
+
 def read_file_from_s3(data_file):
-    uri = "simplecache::{}".format(data_file)
-    endpoint_url = os.environ.get('S3_HOSTNAME', 'https://routines-data-prod.lake.fmi.fi')
-    return fsspec.open_local(uri, s3={'anon': True, 'client_kwargs': {'endpoint_url': endpoint_url}})
+    path = prefetched_file(data_file)
+    if path is not None:
+        return path
+    return download_file_from_s3(data_file)
+
+
+def s3_filesystem():
+    """Anonymous S3 filesystem for reading, shared by all reads of the process"""
+    return S3_READER.filesystem
+
+
+def download_file_from_s3(data_file):
+    """Local path of data_file in the S3 cache, downloading it first if needed"""
+    return S3_READER.local_path(data_file)
+
+
+def download_unindexed_file_from_s3(data_file):
+    """Like download_file_from_s3, but returns None without downloading if data_file has a .idx sidecar"""
+    if S3_READER.cached(data_file) is None and s3_filesystem().exists(data_file + ".idx"):
+        return None
+    return download_file_from_s3(data_file)
 
 
 def read_flash_txt_to_array(file_path):
@@ -136,46 +303,4 @@ def read_flash_txt_to_array(file_path):
 
 
 def read_flash_obs(obstime, time_window):
-    obstime = datetime.datetime.strptime(obstime, "%Y%m%d%H%M")
-    timestr = obstime.strftime("%Y-%m-%dT%H:%M:%S")
-    start_time = obstime - pd.DateOffset(minutes=time_window)
-    older_obs = start_time - pd.DateOffset(minutes=time_window)
-    end_tstr = timestr
-    start_tstr = start_time.strftime("%Y-%m-%dT%H:%M:%S")
-    older_tstr = older_obs.strftime("%Y-%m-%dT%H:%M:%S")
-    url = "http://smartmet.fmi.fi/timeseries?producer={}&tz=gmt&starttime={}&endtime={}&param=flash_id,longitude,latitude,utctime,altitude,peak_current&format=json".format(
-        "flash", start_tstr, end_tstr)
-    resp = requests.get(url)
-    trad_obs = resp.json()
-    obs = pd.DataFrame(trad_obs)
-    obs.rename(columns={"flash_id": "station_id",
-                        "peak_current": "flash",
-                        "altitude": "elevation"}, inplace=True)
-    if len(obs) == 0:
-        obs = obs.assign(latitude=np.nan)
-        obs = obs.assign(longitude=np.nan)
-    obs = obs.assign(flash=100.0)
-    obs = obs.assign(elevation=0.0)
-
-    url_old = "http://smartmet.fmi.fi/timeseries?producer={}&tz=gmt&starttime={}&endtime={}&param=flash_id,longitude,latitude,utctime,altitude,peak_current&format=json".format(
-        "flash", older_tstr, start_tstr)
-    resp_old = requests.get(url_old)
-    trad_obs_old = resp_old.json()
-    obs_old = pd.DataFrame(trad_obs_old)
-    obs_old.rename(columns={"flash_id": "station_id",
-                        "peak_current": "flash",
-                        "altitude": "elevation"}, inplace=True)
-    if len(obs_old) == 0:
-        obs_old = obs_old.assign(latitude=np.nan)
-        obs_old = obs_old.assign(longitude=np.nan)
-    obs_old = obs_old.assign(flash=40.0)
-    obs_old = obs_old.assign(elevation=0.0)
-    result = pd.concat([obs, obs_old])
-
-    count = len(trad_obs)
-    count_old = len(trad_obs_old)
-    if count == 0:
-        print("No near real time observations")
-        if count_old == 0:
-            print("No observations at all from select times")
-    return result
+    return FLASH_CLIENT.read(obstime, time_window)